@@ -0,0 +1,290 @@
+'''
+Description: Keep the signals fresh when the server falls behind, by trading disparity
+            quality for time. The age of every frame, from capture to signal, is compared with
+            a deadline. While frames are late, the disparity handler steps down a ladder of
+            cheaper settings: no WLS filter, a shorter disparity search, downscaled matching,
+            and finally dropping frames. It steps back up once frames leave enough headroom.
+            Usage: python adaptive.py [--deadline 0.2] [--frames 300]
+            runs the controller against a synthetic stage whose cost varies over time.
+'''
+
+
+import time, argparse
+
+
+# Quality levels from the best to the cheapest. Every level holds the DisparityCreator
+# parameters it overrides; 'drop': n processes one frame in n, others reuse the last signal.
+# A 48 pixel search is the shortest whose largest disparity still maps above the nearest
+# threshold, so that closer obstacles saturate as nearest instead of disappearing. Downscaled
+# levels keep the full range, which the scale already halves.
+DEFAULT_LEVELS = (('full', {}),
+                  ('no-wls', {'wls': False}),
+                  ('short-range', {'wls': False, 'num_disparities': 48}),
+                  ('half-scale', {'wls': False, 'scale': 0.5}),
+                  ('drop-half', {'wls': False, 'scale': 0.5, 'drop': 2}))
+
+
+class QualityController(object):
+    '''
+    A class to choose the quality level of every frame from the age of the previous ones.
+    The level steps down as soon as a few consecutive frames miss the deadline, unless the
+    queue left by a slower level is draining fast enough at the current one. It steps up
+    when a whole window of frames was answered well within it. A level which had to be left
+    again right after stepping up to it is retried after a doubled wait, so that the
+    controller does not oscillate at the edge of the capacity.
+    Ages are measured from the capture time stamped by the client when it is known. As the
+    two clocks may differ, only the delay in excess of the smallest delay seen is counted,
+    which is the time a frame spent queued before being received.
+    Methods:
+    begin
+    finish
+    '''
+    def __init__(self, deadline, levels = len(DEFAULT_LEVELS), patience = 2, headroom = 0.6,
+                 window = 30, names = None, log = print, clock = time.time):
+        '''
+        Parameters:
+        deadline: Seconds from capture to signal within which a frame is on time.
+        levels: Number of quality levels, 0 being the best.
+        patience: Number of consecutive late frames before stepping down.
+        headroom: Fraction of the deadline that every frame of a window must stay below
+                  before stepping up.
+        window: Number of consecutive frames with headroom before stepping up. It is doubled
+                for a level every time that level fails within a window of stepping up to it.
+        names: Name of every level, for the log.
+        log: Function called with a line describing every decision, None to stay silent.
+        clock: Function returning the time in seconds, comparable to the capture times.
+        '''
+        self.deadline = deadline
+        self.levels = levels
+        self.patience = patience
+        self.headroom = headroom
+        self.window = window
+        self.names = names or [str(level) for level in range(levels)]
+        self.log = log
+        self.clock = clock
+
+        self.level = 0
+        self.late = 0
+        self.calm = 0
+        self.frames = 0
+        self.stepped_up = False
+        self.last_age = None
+        # Frames with headroom needed before stepping up to every level
+        self.waits = [window] * levels
+        self.min_delay = None
+        self.started = None
+        self.queued = 0.0
+        self.decisions = []
+
+    def begin(self, capture_time = None):
+        '''Description: Start timing a frame.
+        Parameters:
+        capture_time: Time at which the client captured the frame, if known.
+        Return:
+        level: Quality level to process the frame at.
+        '''
+        self.started = self.clock()
+        self.queued = 0.0
+        if capture_time is not None:
+            delay = self.started - capture_time
+            if self.min_delay is None or delay < self.min_delay:
+                self.min_delay = delay
+            self.queued = delay - self.min_delay
+        return self.level
+
+    def finish(self):
+        '''Description: Record that the signal of the frame has been sent, and choose the
+        level of the next frame.
+        Return:
+        age: Seconds from capture to signal of the frame.
+        '''
+        age = self.queued + self.clock() - self.started
+        self.frames += 1
+        # A queue left by a slower level drains for a while. Lateness only counts when, at
+        # the current rate, the queue would not drain within a third of a window.
+        draining = (self.last_age is not None and
+                    age - self.deadline < (self.last_age - age) * self.window / 3)
+        self.last_age = age
+        if age > self.deadline and not draining:
+            self.late += 1
+            self.calm = 0
+            if self.late >= self.patience and self.level < self.levels - 1:
+                if self.stepped_up and self.frames <= self.window:
+                    self.waits[self.level] = min(self.waits[self.level] * 2, 8 * self.window)
+                elif self.frames > self.window:
+                    self.waits[self.level] = self.window
+                self._change(self.level + 1, age)
+        elif age > self.deadline:
+            self.calm = 0
+        else:
+            self.late = 0
+            self.calm = self.calm + 1 if age < self.headroom * self.deadline else 0
+            if self.level and self.calm >= self.waits[self.level - 1]:
+                self._change(self.level - 1, age)
+        return age
+
+    def _change(self, level, age):
+        previous = self.level
+        self.stepped_up = level < previous
+        self.level = level
+        self.late = 0
+        self.calm = 0
+        self.frames = 0
+        self.decisions.append((previous, level, age))
+        if self.log is not None:
+            self.log('Quality {} -> {}: frame age {:.0f} ms, deadline {:.0f} ms'.format(
+                     self.names[previous], self.names[level], age * 1000, self.deadline * 1000))
+
+
+class AdaptiveDisparity(object):
+    '''
+    A class to compute disparity at the quality level chosen by a QualityController, with
+    the same interface as DisparityCreator. A handler is created for every level the first
+    time it is used, and kept, so that switching levels costs nothing.
+    Methods:
+    begin
+    finish
+    get_disparity
+    close
+    '''
+    def __init__(self, create_handler, deadline, levels = DEFAULT_LEVELS, **kwargs):
+        '''
+        Parameters:
+        create_handler: Function creating a disparity handler from a dict of DisparityCreator
+                        parameters overriding the server's ones.
+        deadline: Seconds from capture to signal within which a frame is on time.
+        levels: Sequence of (name, parameters) quality levels, from the best.
+        kwargs: Further QualityController parameters.
+        '''
+        self.create_handler = create_handler
+        self.levels = levels
+        self.controller = QualityController(deadline, len(levels),
+                                            names = [name for name, _ in levels], **kwargs)
+        self.handlers = {}
+        self.level = 0
+        self.skipped = 0
+
+    def begin(self, capture_time = None):
+        '''Description: Start a frame.
+        Parameters:
+        capture_time: Time at which the client captured the frame, if known.
+        Return:
+        process: False if the frame should be dropped, answering it with the last signal.
+        '''
+        self.level = self.controller.begin(capture_time)
+        drop = self.levels[self.level][1].get('drop', 1)
+        self.skipped = (self.skipped + 1) % drop if drop > 1 else 0
+        return self.skipped == 0
+
+    def finish(self):
+        '''Description: Record that the signal of the frame has been sent.
+        '''
+        return self.controller.finish()
+
+    def get_disparity(self, left_img, right_img):
+        '''Get disparity map for corresponding left and right images, at the current level.
+        '''
+        handler = self.handlers.get(self.level)
+        if handler is None:
+            parameters = dict(self.levels[self.level][1])
+            parameters.pop('drop', None)
+            handler = self.handlers[self.level] = self.create_handler(parameters)
+        return handler.get_disparity(left_img, right_img)
+
+    def close(self):
+        for handler in self.handlers.values():
+            handler.close()
+        self.handlers = {}
+
+
+class SyntheticStage(object):
+    '''A stand-in disparity handler for testing the controller without images. The cost of a
+    frame depends on the level parameters and on a load factor which the test can change.
+    '''
+    def __init__(self, clock, parameters, load):
+        self.clock = clock
+        self.parameters = parameters
+        self.load = load
+
+    def cost(self):
+        cost = 0.05 * self.load[0]
+        if not self.parameters.get('wls', True):
+            cost *= 0.5
+        cost *= self.parameters.get('num_disparities', 64) / 64.0
+        return cost * self.parameters.get('scale', 1) ** 2
+
+    def get_disparity(self, left_img, right_img):
+        self.clock.advance(self.cost())
+        return None
+
+    def close(self):
+        return
+
+
+class SimulatedClock(object):
+    '''Time which only moves when advanced, so that simulations are exact and instant.
+    '''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def simulate(load_profile, deadline = 0.2, interval = 1 / 15.0, log = None, **kwargs):
+    '''Description: Run the sequential server loop against synthetic stages, with frames
+    captured at a fixed rate and processed one at a time.
+    Parameters:
+    load_profile: Load factor of every frame, scaling the stage cost. Its length is the
+                  number of frames.
+    deadline: Seconds from capture to signal within which a frame is on time.
+    interval: Seconds between two captures.
+    log: Function called with every decision.
+    kwargs: Further QualityController parameters.
+    Return:
+    report: dict with the age and level of every frame, and the controller decisions.
+    '''
+    clock = SimulatedClock()
+    load = [1.0]
+    adaptive = AdaptiveDisparity(lambda parameters: SyntheticStage(clock, parameters, load),
+                                 deadline, log = log, clock = clock, **kwargs)
+    ages = []
+    levels = []
+    for index, factor in enumerate(load_profile):
+        capture_time = index * interval
+        # The frame waits in the socket until both its capture and the previous frame are done
+        clock.now = max(clock.now, capture_time)
+        load[0] = factor
+        if adaptive.begin(capture_time):
+            adaptive.get_disparity(None, None)
+            # Thresholds, segmentation and sending
+            clock.advance(0.005)
+        levels.append(adaptive.level)
+        ages.append(adaptive.finish())
+    return {'ages': ages, 'levels': levels, 'decisions': adaptive.controller.decisions}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Simulate the adaptive quality controller.')
+    parser.add_argument('--deadline', type = float, default = 0.2, help = 'Deadline in seconds')
+    parser.add_argument('--frames', type = int, default = 300, help = 'Number of frames')
+    parser.add_argument('--fps', type = float, default = 15, help = 'Capture rate')
+    args = parser.parse_args()
+
+    # Light load, a heavy spell in the middle, then light load again
+    third = args.frames // 3
+    load_profile = [1.0] * third + [2.5] * third + [1.0] * (args.frames - 2 * third)
+    report = simulate(load_profile, args.deadline, 1 / args.fps, log = print)
+    for start in range(0, args.frames, third):
+        ages = report['ages'][start:start + third]
+        late = sum(age > args.deadline for age in ages)
+        print('Frames {}-{}: load {}, max age {:.0f} ms, {} late, levels {}'.format(
+              start, start + len(ages) - 1, load_profile[start], max(ages) * 1000, late,
+              sorted(set(report['levels'][start:start + third]))))
+
+
+if __name__ == '__main__':
+    main()
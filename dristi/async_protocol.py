@@ -0,0 +1,348 @@
+'''
+Description: Asynchronous variant of the client/server protocol, built on asyncio.
+            The client keeps several frames in flight instead of waiting for each signal,
+            so capture, transmission and computation overlap. Every signal carries the id
+            of the frame it was computed from; replies older than the latest applied signal
+            are discarded. Fallback replies, which only release a frame the server dropped,
+            are never applied. Run this file to compare lock-step and pipelined throughput on a
+            local loopback connection.
+'''
+
+
+import asyncio, time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from protocol import (MAGIC, VERSION, HELLO, HEADER, SIGNAL, ENCODINGS, ENCODING_RAW,
+                      FrameEncoder, FrameDecoder, pack_signal, unpack_signal)
+
+
+async def request_encoding_async(reader, writer, encoding):
+    '''Description: Client side of the hello exchange, see protocol.request_encoding.
+    '''
+    writer.write(HELLO.pack(MAGIC, VERSION, encoding))
+    magic, version, encoding = HELLO.unpack(await reader.readexactly(HELLO.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported server protocol version {}'.format(version))
+    return encoding
+
+
+async def accept_encoding_async(reader, writer, supported = tuple(ENCODINGS.values())):
+    '''Description: Server side of the hello exchange, see protocol.accept_encoding.
+    '''
+    magic, version, encoding = HELLO.unpack(await reader.readexactly(HELLO.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported client protocol version {}'.format(version))
+    if encoding not in supported:
+        encoding = ENCODING_RAW
+    writer.write(HELLO.pack(MAGIC, VERSION, encoding))
+    await writer.drain()
+    return encoding
+
+
+class AsyncServer(object):
+    '''A class to serve stereo frames asynchronously, to one or several clients.
+    Frames are read as soon as they arrive and queued for a pool of compute threads.
+    When computation falls behind, the oldest queued frames are skipped without a reply,
+    the client then releases them when the answer to a newer frame arrives.
+    Every client has at most one frame submitted to the pool at a time, so the pool serves
+    clients in turn, and a slow client only ever delays its own frames.
+    Methods:
+    serve
+    start
+    '''
+    def __init__(self, compute, queue_size = 2, metrics = None, workers = 1,
+                 session_factory = None):
+        '''
+        Parameters:
+        compute: Callable taking the left and right images and returning a signal.
+                 With metrics, it is also passed the frame's FrameTimer as timer.
+        queue_size: Number of received frames waiting for computation, per client.
+        metrics: Optional FrameMetrics.
+        workers: Number of compute threads shared by all clients.
+        session_factory: Optional callable taking a client address and returning the state
+                         of that client: a callable used instead of compute, with a close
+                         method called when the client disconnects.
+        '''
+        self.compute = compute
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.session_factory = session_factory
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.processed = 0
+        self.skipped = 0
+        self.connections = set()
+
+    async def serve(self, host, port):
+        '''Description: Serve clients until cancelled.
+        '''
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def start(self, host, port):
+        '''Description: Start listening and return the asyncio server.
+        '''
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def wait_closed(self):
+        '''Description: Wait until every client connection has been served.
+        '''
+        if self.connections:
+            await asyncio.wait(self.connections)
+
+    async def handle(self, reader, writer):
+        '''Description: Serve a single client connection.
+        '''
+        self.connections.add(asyncio.current_task())
+        loop = asyncio.get_running_loop()
+        encoding = await accept_encoding_async(reader, writer)
+        decoder = FrameDecoder(encoding)
+        session = None
+        compute = self.compute
+        # Creating a session loads calibration files and decoding runs image codecs. Both
+        # run on the default executor, so that the loop keeps serving the other clients.
+        if self.session_factory is not None:
+            session = compute = await loop.run_in_executor(
+                None, self.session_factory, writer.get_extra_info('peername'))
+        frames = asyncio.Queue()
+        # Buffers of skipped and computed frames, a frame keeps its buffer until then.
+        # At most queue_size + 2 buffers exist: the queue, the frame being computed and the
+        # frame being received.
+        free = []
+        worker = asyncio.ensure_future(self._process(frames, writer, compute, free))
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                width, height, frame_id, length = decoder.parse_header(header)
+                timer = None
+                if self.metrics is not None:
+                    timer = self.metrics.start_frame(frame_id, decoder.capture_time)
+                payload = await reader.readexactly(length)
+
+                buffer = free.pop() if free else None
+                if buffer is None or buffer.shape != (height, width):
+                    buffer = np.empty((height, width), dtype = np.uint8)
+                await loop.run_in_executor(None, decoder.decode_into, payload, buffer)
+                if timer is not None:
+                    timer.mark('receive')
+
+                if frames.qsize() >= self.queue_size:
+                    _, skipped_buffer, skipped_timer = frames.get_nowait()
+                    free.append(skipped_buffer)
+                    self.skipped += 1
+                    if self.metrics is not None:
+                        self.metrics.drop(skipped_timer)
+                frames.put_nowait((frame_id, buffer, timer))
+        finally:
+            frames.put_nowait(None)
+            await worker
+            writer.close()
+            if session is not None:
+                session.close()
+            self.connections.discard(asyncio.current_task())
+
+    async def _process(self, frames, writer, compute, free):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                return
+            frame_id, buffer, timer = frame
+            width = buffer.shape[1]
+            if timer is None:
+                job = partial(compute, buffer[:, :width // 2], buffer[:, width // 2:])
+            else:
+                job = partial(self._timed, compute, buffer[:, :width // 2],
+                              buffer[:, width // 2:], timer)
+            signal = await loop.run_in_executor(self.executor, job)
+            free.append(buffer)
+            self.processed += 1
+            writer.write(pack_signal(frame_id, signal))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+            if timer is not None:
+                timer.mark('send')
+                self.metrics.finish(timer)
+
+    @staticmethod
+    def _timed(compute, left_img, right_img, timer):
+        # Waits in the client's queue and for a free worker end when the job starts
+        timer.mark('queued')
+        return compute(left_img, right_img, timer = timer)
+
+
+class AsyncClient(object):
+    '''A class to stream frames to the server with several frames in flight.
+    Methods:
+    run
+    '''
+    def __init__(self, capture, on_signal, encoding = ENCODING_RAW, in_flight = 3, quality = 90):
+        '''
+        Parameters:
+        capture: Blocking callable returning a new side by side image on every call,
+                 or None to stop. It is run on a worker thread.
+        on_signal: Callable taking the frame id and the signal, for every applied signal.
+        encoding: Frame encoding to request from the server.
+        in_flight: Maximum number of frames sent but not yet answered.
+        quality: JPEG quality.
+        '''
+        self.capture = capture
+        self.on_signal = on_signal
+        self.encoding = encoding
+        self.in_flight = in_flight
+        self.quality = quality
+        self.executor = ThreadPoolExecutor(max_workers = 1)
+        self.pending = {}
+        self.latest = 0
+        self.sent = 0
+        self.applied = 0
+        self.late = 0
+        self.unanswered = 0
+        self.latency = 0.0
+        self.error = None
+
+    async def run(self, host, port, frames = None):
+        '''Description: Stream frames until capture returns None, or frames have been sent.
+        Raises: The error which stopped receiving signals, e.g. asyncio.IncompleteReadError
+                when the server closed the connection.
+        '''
+        loop = asyncio.get_running_loop()
+        reader, writer = await asyncio.open_connection(host, port)
+        encoding = await request_encoding_async(reader, writer, self.encoding)
+        encoder = FrameEncoder(encoding, quality = self.quality)
+        self.window = asyncio.Condition()
+        self.error = None
+        receiver = asyncio.ensure_future(self._receive(reader))
+        # Waits end early once the receiver stopped, no answer can free the window then
+        stopped = lambda: self.error is not None or receiver.done()
+
+        try:
+            frame_id = 0
+            while frames is None or frame_id < frames:
+                async with self.window:
+                    await self.window.wait_for(
+                        lambda: stopped() or len(self.pending) < self.in_flight)
+                self._check(receiver)
+                image = await loop.run_in_executor(self.executor, self.capture)
+                capture_time = time.time()
+                if image is None:
+                    break
+                frame_id += 1
+                header, payload = encoder.encode(frame_id, image, capture_time)
+                self.pending[frame_id] = time.monotonic()
+                writer.write(header)
+                writer.write(payload)
+                await writer.drain()
+                self.sent += 1
+
+            async with self.window:
+                await self.window.wait_for(lambda: stopped() or not self.pending)
+            self._check(receiver)
+        finally:
+            receiver.cancel()
+            writer.close()
+        await writer.wait_closed()
+
+    def _check(self, receiver):
+        if self.error is not None:
+            raise self.error
+        if receiver.done() and not receiver.cancelled():
+            receiver.result()
+
+    async def _receive(self, reader):
+        try:
+            await self._receive_signals(reader)
+        except Exception as error:
+            # Kept for run to raise, which would otherwise wait for answers forever
+            self.error = error
+            async with self.window:
+                self.window.notify_all()
+
+    async def _receive_signals(self, reader):
+        while True:
+            frame_id, signal = unpack_signal(await reader.readexactly(SIGNAL.size))
+            async with self.window:
+                if signal.get('fallback'):
+                    # A frame the server dropped, answers to older frames may still come
+                    self.pending.pop(frame_id, None)
+                    self.unanswered += 1
+                    self.window.notify_all()
+                    continue
+                if frame_id <= self.latest:
+                    self.late += 1
+                else:
+                    self.latest = frame_id
+                    self.latency += time.monotonic() - self.pending[frame_id]
+                    self.applied += 1
+                    self.on_signal(frame_id, signal)
+                for key in [key for key in self.pending if key <= frame_id]:
+                    if key != frame_id:
+                        self.unanswered += 1
+                    del self.pending[key]
+                self.window.notify_all()
+
+    def report(self):
+        '''Description: Summarise the counters.
+        '''
+        return {'sent': self.sent, 'applied': self.applied, 'late': self.late,
+                'unanswered': self.unanswered,
+                'latency_ms': self.latency / max(self.applied, 1) * 1000}
+
+
+def benchmark_loopback(frames = 100, in_flight = (1, 2, 4), capture_time = 0.01,
+                       compute_time = 0.03, encoding = 'raw', width = 1280, height = 480):
+    '''Description: Run a server and a client over a local loopback connection with
+    synthetic capture and compute stages, and compare the throughput obtained with
+    different numbers of frames in flight. in_flight = 1 behaves like the lock-step protocol.
+    Parameters:
+    frames: Number of frames to send for each setting.
+    in_flight: Settings to compare.
+    capture_time: Seconds spent capturing each frame.
+    compute_time: Seconds spent computing each signal.
+    encoding: Frame encoding.
+    Return:
+    results: List of dicts with fps and client counters per setting.
+    '''
+    image = (np.random.rand(height, width) * 255).astype(np.uint8)
+    signal = {'nearest': [0, 1, 0], 'middle': [0, 0, 0, 0]}
+
+    def capture():
+        time.sleep(capture_time)
+        return image.copy()
+
+    def compute(left_img, right_img):
+        time.sleep(compute_time)
+        return signal
+
+    async def run(window):
+        server = AsyncServer(compute)
+        listener = await server.start('127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        client = AsyncClient(capture, lambda frame_id, signal: None, ENCODINGS[encoding], window)
+        start = time.monotonic()
+        await client.run('127.0.0.1', port, frames)
+        elapsed = time.monotonic() - start
+        listener.close()
+        await listener.wait_closed()
+        await server.wait_closed()
+        result = client.report()
+        result.update({'in_flight': window, 'fps': frames / elapsed,
+                       'signal_fps': client.applied / elapsed})
+        return result
+
+    return [asyncio.run(run(window)) for window in in_flight]
+
+
+if __name__ == '__main__':
+    for result in benchmark_loopback():
+        print('{in_flight} in flight: {fps:6.1f} fps sent, {signal_fps:6.1f} signals/s, '
+              '{latency_ms:6.1f} ms latency, '
+              '{applied} applied, {unanswered} unanswered, {late} late'.format(**result))
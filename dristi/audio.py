@@ -1,43 +1,59 @@
 import numpy as np
-import sounddevice as sd
 
 
 
 class AudioFeedback(object):
     '''A class to handle Audio feedback to the user.
+    Audio is generated block by block in the callback of a single output stream, by a phase
+    accumulator oscillator writing into the stream's buffer. A new signal only swaps the
+    target frequency and channel gains, which the next block fades to, so a warning is heard
+    within one block, without restarting playback or allocating sound buffers.
     Methods:
     init_playback
     update
+    render
     stop
     '''
-    def __init__(self, fs = 44100, duration = 10, volume = 0.3, channels = 2):
+    def __init__(self, fs = 44100, volume = 0.3, channels = 2, blocksize = 256, stream = True):
         '''
         Description: Initialise playback
         Parameters:
         fs : Sampling Frequency for the output audio.
-        duration: Duration of each playback to be played, but can be changed in the middle
         volume: Volume for the audio output
         channels: No of channels being used.
+        blocksize: Number of frames generated per callback, bounding the update latency.
+        stream: Open an output stream on the default device. Otherwise audio is only
+                produced by render, e.g. for testing without a sound card.
         '''
         self.fs = fs
-        self.duration = duration
         self.volume = volume
         self.channels = channels
+        self.blocksize = blocksize
 
-        sound_1 = (np.sin(2*np.pi*np.arange(self.fs*self.duration)*440/self.fs)).astype(np.float32)
-        sound_2 = (np.sin(2*np.pi*np.arange(self.fs*self.duration)*500/self.fs)).astype(np.float32)
-        sound_3 = (np.sin(2*np.pi*np.arange(self.fs*self.duration)*540/self.fs)).astype(np.float32)
+        self.frequency_map = {1: 440, 2: 500, 3: 540}
+        # Target of the next block, replaced as a whole so the callback never sees half an update
+        self.target = (self.frequency_map[1], (0.0,) * channels)
+        self.gains = (0.0,) * channels
+        self.phase = 0.0
 
-        self.frequency_map = {1: sound_1, 2: sound_2, 3: sound_3}
-        self.size = sound_1.size
-        self.init_playback()
+        self.steps = np.arange(1, blocksize + 1, dtype = np.float64)
+        self.ramp = self.steps / blocksize
+        self.wave = np.empty(blocksize)
+        self.gain = np.empty(blocksize)
+
+        self.stream = None
+        if stream:
+            self.init_playback()
 
     def init_playback(self):
         '''
-        Description: Set some default values of playback.
+        Description: Open and start the output stream.
         '''
-        sd.default.samplerate = self.fs
-        sd.default.channels = self.channels
+        import sounddevice as sd
+        self.stream = sd.OutputStream(samplerate = self.fs, channels = self.channels,
+                                      blocksize = self.blocksize, dtype = 'float32',
+                                      latency = 'low', callback = self._callback)
+        self.stream.start()
 
     def update(self, signal):
         '''
@@ -45,23 +61,59 @@ class AudioFeedback(object):
         Parameters:
         signal: Control signal
         '''
+        frequency, _ = self.target
+        gains = [0.0] * self.channels
         freq = signal.count(1)
-        sound = np.zeros([self.size, 2])
-        if signal[0] == 0 and signal[1] == 1 and signal[2] == 0:
-            sound = np.hstack([self.frequency_map[freq], self.frequency_map[freq]])
-        else:
-            if signal[0] == 1:
-                sound[:, 0] = self.frequency_map[freq]
-            if signal[2] == 1:
-                sound[:, 1] = self.frequency_map[freq]
+        if freq in self.frequency_map:
+            frequency = self.frequency_map[freq]
+            if signal[0] == 0 and signal[1] == 1 and signal[2] == 0:
+                gains = [self.volume] * self.channels
+            else:
+                if signal[0] == 1:
+                    gains[0] = self.volume
+                if signal[2] == 1:
+                    gains[1] = self.volume
+        self.target = (frequency, tuple(gains))
+
+    def _callback(self, outdata, frames, time, status):
+        frequency, target = self.target
+        wave = self.wave[:frames]
+        gain = self.gain[:frames]
+        ramp = self.ramp[:frames] if frames == self.blocksize else self.steps[:frames] / frames
+
+        np.multiply(self.steps[:frames], 2 * np.pi * frequency / self.fs, out = wave)
+        wave += self.phase
+        self.phase = wave[-1] % (2 * np.pi)
+        np.sin(wave, out = wave)
+
+        for channel, (start, end) in enumerate(zip(self.gains, target)):
+            np.multiply(ramp, end - start, out = gain)
+            gain += start
+            np.multiply(wave, gain, out = outdata[:, channel])
+        self.gains = target
 
-        sd.play(self.volume* sound, loop = True, mapping = [1, 2])
+    def render(self, frames):
+        '''
+        Description: Generate audio without an output device.
+        Parameters:
+        frames: Number of frames to generate.
+        Return:
+        (frames, channels) float32 array, as it would have been played.
+        '''
+        out = np.zeros((frames, self.channels), dtype = np.float32)
+        for start in range(0, frames, self.blocksize):
+            block = out[start:start + self.blocksize]
+            self._callback(block, len(block), None, None)
+        return out
 
     def stop(self):
         '''
         Description: Stop playback
         '''
-        sd.stop()
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
 
 
 
@@ -69,10 +121,9 @@ if __name__ == '__main__':
     '''For testing purpose
     '''
     fs = 44100
-    duration = 10.0
     volume = 0.3
     channels = 2
-    feedback = AudioFeedback(fs = fs, duration = duration, volume = volume, channels = channels)
+    feedback = AudioFeedback(fs = fs, volume = volume, channels = channels)
 
     while True:
         try:
@@ -0,0 +1,189 @@
+'''
+Description: Run the server processing headless over a folder of recorded left/right pairs,
+            e.g. to validate new thresholds on a whole dataset.
+            Pairs are indexed once with ReadImages and split into chunks, which a pool of
+            worker processes decodes and processes. Every worker creates its calibration,
+            DisparityCreator and segmentation once, and disparity maps are written by the
+            workers themselves. Signals are appended to signals.jsonl in frame order, one line
+            per pair, as soon as every earlier chunk is done. A batch which was interrupted
+            resumes after the last pair recorded there.
+            Usage: python batch.py <images_folder> <output_folder> [--calibration folder]
+                                   [--workers N] [--disparity png|npz] [--restart]
+'''
+
+
+import os, json, time, argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+
+SIGNALS = 'signals.jsonl'
+
+STATE = {}
+
+
+def _init_worker(folder, calibration_folder, output, disparity_format):
+    '''Description: Index the pairs and create the processing state of a worker process.
+    '''
+    from image_loader import ReadImages
+    from laptop_server import CALIBRATION_FOLDER, disparity_profile, create_segmentation
+    from disparity import DisparityCreator
+
+    # Processes already use every core
+    cv2.setNumThreads(1)
+    STATE['loader'] = ReadImages(folder, grayscale = True, prefetch = 0)
+    STATE['calibration_folder'] = calibration_folder or CALIBRATION_FOLDER
+    STATE['calibration'] = None
+    STATE['disparity_handler'] = DisparityCreator(**disparity_profile())
+    STATE['create_segmentation'] = create_segmentation
+    STATE['output'] = output
+    STATE['format'] = disparity_format
+
+
+def _process_chunk(start, end):
+    '''Description: Compute the signals of the pairs [start, end) of the index, writing their
+    disparity maps if requested.
+    Return:
+    records: List of one dict per pair, with its index, name and signal.
+    '''
+    from load_calibration import Calibration
+    from laptop_server import preprocess, segment
+
+    loader = STATE['loader']
+    disparity_handler = STATE['disparity_handler']
+    records = []
+    for index in range(start, end):
+        left_img, right_img = loader.read(index)
+        if left_img is None or right_img is None:
+            raise IOError('Could not decode {}'.format(loader.pairs[index]))
+        if STATE['calibration'] is None:
+            calibration = Calibration(left_img.shape[1::-1])
+            calibration.load_calibration_files(STATE['calibration_folder'])
+            STATE['calibration'] = calibration
+            STATE['segmentation'] = STATE['create_segmentation'](calibration)
+
+        left_img, right_img = preprocess(STATE['calibration'], left_img, right_img)
+        disparity = disparity_handler.get_disparity(left_img, right_img)
+        signal = segment(disparity_handler, STATE['segmentation'], disparity)
+
+        name = pair_name(loader.pairs[index])
+        if STATE['format'] == 'png':
+            cv2.imwrite(os.path.join(STATE['output'], 'disparity{}.png'.format(name)), disparity)
+        elif STATE['format'] == 'npz':
+            np.savez_compressed(os.path.join(STATE['output'], 'disparity{}.npz'.format(name)),
+                                disparity = disparity)
+        records.append(dict(signal, index = index, name = name))
+    return records
+
+
+def pair_name(files):
+    '''Description: Sequence number of a pair, i.e. its left file name without the prefix
+    and extension.
+    '''
+    return os.path.splitext(os.path.basename(files[0]))[0][len('left'):]
+
+
+def completed_pairs(filename, pairs):
+    '''Description: Number of pairs already recorded in a signals file, dropping a last line
+    which was cut short by an interruption.
+    '''
+    if not os.path.exists(filename):
+        return 0
+    count = 0
+    end = 0
+    with open(filename, 'rb') as file:
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            record = json.loads(line)
+            if (record['index'] != count or count >= len(pairs)
+                    or record['name'] != pair_name(pairs[count])):
+                raise ValueError('{} does not match the pairs of this folder, use --restart'
+                                 .format(filename))
+            count += 1
+            end += len(line)
+    with open(filename, 'r+b') as file:
+        file.truncate(end)
+    return count
+
+
+def run_batch(folder, output, calibration_folder = None, workers = None, chunk_size = 16,
+              disparity_format = None, restart = False, log = print):
+    '''Description: Process every pair of a folder, resuming a previous run unless restarted.
+    Parameters:
+    folder: Folder of left<n>/right<n> images, as read by ReadImages.
+    output: Folder receiving signals.jsonl and the disparity maps.
+    calibration_folder: Calibration folder, the server's default if None.
+    workers: Number of worker processes, defaults to the number of cores.
+    chunk_size: Number of consecutive pairs processed by a worker at a time.
+    disparity_format: 'png' or 'npz' to write every disparity map, None to skip them.
+    restart: Discard the results of a previous run.
+    log: Function called with progress lines, None to stay silent.
+    Return:
+    report: dict with the number of pairs processed, skipped and the throughput.
+    '''
+    from image_loader import ReadImages
+
+    os.makedirs(output, exist_ok = True)
+    pairs = ReadImages(folder, prefetch = 0).pairs
+    filename = os.path.join(output, SIGNALS)
+    if restart and os.path.exists(filename):
+        os.remove(filename)
+    done = completed_pairs(filename, pairs)
+    if log is not None and done:
+        log('Resuming after {} of {} pairs'.format(done, len(pairs)))
+
+    workers = workers or os.cpu_count()
+    chunks = deque((start, min(start + chunk_size, len(pairs)))
+                   for start in range(done, len(pairs), chunk_size))
+    start_time = time.perf_counter()
+    processed = 0
+    with ProcessPoolExecutor(max_workers = workers, mp_context = get_context('spawn'),
+                             initializer = _init_worker,
+                             initargs = (folder, calibration_folder, output,
+                                         disparity_format)) as executor, \
+         open(filename, 'a') as file:
+        # Enough chunks in flight to keep every worker busy, few enough to bound memory
+        pending = deque()
+        while chunks or pending:
+            while chunks and len(pending) < 2 * workers:
+                pending.append(executor.submit(_process_chunk, *chunks.popleft()))
+            records = pending.popleft().result()
+            for record in records:
+                file.write(json.dumps(record) + '\n')
+            file.flush()
+            processed += len(records)
+            if log is not None:
+                elapsed = time.perf_counter() - start_time
+                log('{}/{} pairs, {:.1f} pairs/s'.format(done + processed, len(pairs),
+                                                         processed / elapsed))
+    elapsed = time.perf_counter() - start_time
+    return {'pairs': len(pairs), 'processed': processed, 'skipped': done,
+            'pairs_per_second': processed / elapsed if elapsed else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Process a folder of recorded pairs.')
+    parser.add_argument('images', help = 'Folder of left/right images')
+    parser.add_argument('output', help = 'Folder to write signals.jsonl and disparity maps to')
+    parser.add_argument('--calibration', help = 'Calibration folder')
+    parser.add_argument('--workers', type = int, help = 'Number of processes')
+    parser.add_argument('--chunk', type = int, default = 16, help = 'Pairs per task')
+    parser.add_argument('--disparity', choices = ('png', 'npz'),
+                        help = 'Write every disparity map in this format')
+    parser.add_argument('--restart', action = 'store_true',
+                        help = 'Discard the results of a previous run')
+    args = parser.parse_args()
+
+    report = run_batch(args.images, args.output, args.calibration, args.workers, args.chunk,
+                       args.disparity, args.restart)
+    print('{processed} pairs processed ({skipped} already done) at {pairs_per_second:.1f} '
+          'pairs/s'.format(**report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+'''
+Description: Offline benchmark of the server processing, without cameras or a Raspberry Pi.
+            Frames come from a folder of left/right images read with ReadImages, or from a
+            synthetic stereo pair generator, rectified with a synthetic identity calibration
+            unless a calibration folder is given. Every stage is timed over N frames and the
+            report is written as JSON. Two configurations can be compared to catch regressions.
+            With --startup, the time from a fresh process to the first processed frame is
+            reported instead, without and with the calibration bundle.
+            Usage: python benchmark.py [--images folder] [--frames N] [--config a.json]
+                                       [--compare b.json] [--output report.json]
+                   python benchmark.py --startup [--calibration folder]
+'''
+
+
+import os, sys, json, time, glob, shutil, argparse, resource, tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+
+IMAGE_WIDTH = 640
+IMAGE_HEIGHT = 480
+
+DEFAULT_CONFIG = {'Lambda': 16000, 'sigma': 7, 'concurrent': True, 'strips': 1,
+                  'scale': 1, 'temporal': False, 'encoding': 'raw'}
+STAGES = ('preprocess', 'get_disparity', 'apply_thresholds', 'apply_segmentation',
+          'serialization', 'total')
+
+
+def synthetic_pairs(count, width = IMAGE_WIDTH, height = IMAGE_HEIGHT, seed = 0):
+    '''Description: Generate rectified grayscale stereo pairs of a textured background with
+    a few closer textured boxes, moving slightly from one frame to the next.
+    Parameters:
+    count: Number of pairs.
+    width, height: Size of each image.
+    seed: Seed of the random generator.
+    Return:
+    pairs: List of (left, right) uint8 images.
+    '''
+    rng = np.random.default_rng(seed)
+    texture = cv2.GaussianBlur((rng.random((height, width * 2)) * 255).astype(np.uint8), (5, 5), 0)
+    boxes = [(rng.integers(0, width - 200), rng.integers(0, height - 200),
+              rng.integers(80, 200), rng.integers(80, 200), rng.integers(30, 60))
+             for _ in range(3)]
+
+    pairs = []
+    for index in range(count):
+        background = 8
+        left = np.roll(texture, -index, axis = 1)[:, :width].copy()
+        right = np.roll(texture, -index - background, axis = 1)[:, :width].copy()
+        for x, y, w, h, disparity in boxes:
+            x = (x + 2 * index) % (width - w - disparity)
+            patch = texture[y:y + h, width:width + w]
+            left[y:y + h, x + disparity:x + disparity + w] = patch
+            right[y:y + h, x:x + w] = patch
+        pairs.append((left, right))
+    return pairs
+
+
+def load_pairs(folder, count):
+    '''Description: Load up to count grayscale pairs with ReadImages.
+    '''
+    from image_loader import ReadImages
+    loader = ReadImages(folder, grayscale = True)
+    pairs = [loader.load_images() for _ in range(min(count, len(loader)))]
+    loader.stop()
+    return pairs
+
+
+def summarise(samples):
+    '''Description: Latency percentiles of a list of durations in seconds.
+    '''
+    samples = np.asarray(samples) * 1000
+    return {'p50_ms': float(np.percentile(samples, 50)),
+            'p95_ms': float(np.percentile(samples, 95)),
+            'p99_ms': float(np.percentile(samples, 99)),
+            'mean_ms': float(samples.mean())}
+
+
+def run_benchmark(config = None, images = None, calibration_folder = None, frames = 100,
+                  warmup = 3):
+    '''Description: Time every stage of the server processing.
+    Parameters:
+    config: dict overriding DEFAULT_CONFIG.
+    images: Folder of left/right images, synthetic pairs are used if None.
+    calibration_folder: Calibration folder, an identity calibration is used if None.
+    frames: Number of frames timed. Pairs are cycled if there are fewer.
+    warmup: Number of untimed frames run first.
+    Return:
+    report: dict with per stage latency percentiles, fps and peak RSS.
+    '''
+    from load_calibration import Calibration
+    from disparity import DisparityCreator
+    from segmentation import SegmentationEngine
+    from temporal import TemporalDisparity
+    from protocol import ENCODINGS, FrameEncoder, FrameDecoder, pack_signal
+    from laptop_server import preprocess
+
+    settings = dict(DEFAULT_CONFIG, **(config or {}))
+    pairs = load_pairs(images, frames) if images else synthetic_pairs(min(frames, 30))
+    if not pairs:
+        raise ValueError('No image pairs found in {}'.format(images))
+    height, width = pairs[0][0].shape
+
+    calibration = Calibration((width, height))
+    if calibration_folder:
+        calibration.load_calibration_files(calibration_folder)
+    else:
+        calibration.load_identity()
+    disparity_handler = DisparityCreator(settings['Lambda'], settings['sigma'],
+                                         concurrent = settings['concurrent'],
+                                         strips = settings['strips'], scale = settings['scale'])
+    if settings['temporal']:
+        disparity_handler = TemporalDisparity(disparity_handler)
+    segmentation = SegmentationEngine()
+    encoder = FrameEncoder(ENCODINGS[settings['encoding']])
+    decoder = FrameDecoder(ENCODINGS[settings['encoding']])
+    received = np.empty((height, width * 2), dtype = np.uint8)
+
+    timings = {stage: [] for stage in STAGES}
+    start_all = None
+    for index in range(warmup + frames):
+        if index == warmup:
+            start_all = time.perf_counter()
+        left_img, right_img = pairs[index % len(pairs)]
+        clock = [time.perf_counter()]
+
+        rectified_left, rectified_right = preprocess(calibration, left_img, right_img)
+        clock.append(time.perf_counter())
+        disparity = disparity_handler.get_disparity(rectified_left, rectified_right)
+        clock.append(time.perf_counter())
+        nearest, middle = segmentation.apply_thresholds(disparity)
+        clock.append(time.perf_counter())
+        signal = segmentation.apply_segmentation(nearest, middle)
+        clock.append(time.perf_counter())
+        _, payload = encoder.encode(index, np.hstack((left_img, right_img)))
+        decoder.decode_into(payload, received)
+        pack_signal(index, signal)
+        clock.append(time.perf_counter())
+
+        if index >= warmup:
+            for stage, begin, end in zip(STAGES, clock, clock[1:]):
+                timings[stage].append(end - begin)
+            timings['total'].append(clock[-1] - clock[0])
+    elapsed = time.perf_counter() - start_all
+
+    return {'config': settings,
+            'frames': frames,
+            'source': images or 'synthetic',
+            'stages': {stage: summarise(samples) for stage, samples in timings.items()},
+            'fps': frames / elapsed,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def run_isolated(function, *args):
+    '''Description: Run a benchmark in a fresh process, so that peak RSS is not shared.
+    '''
+    with ProcessPoolExecutor(max_workers = 1, mp_context = get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def measure_startup(calibration_folder):
+    '''Description: Time every step of the server start up to the first processed frame.
+    Meant to run in a fresh process, where numpy and cv2 are already imported.
+    Return:
+    report: dict of step to milliseconds.
+    '''
+    clock = [time.perf_counter()]
+    import laptop_server
+    clock.append(time.perf_counter())
+    calibration = laptop_server.load_calibration(calibration_folder)
+    clock.append(time.perf_counter())
+    disparity_handler = laptop_server.create_disparity_handler(calibration)
+    segmentation = laptop_server.create_segmentation(calibration)
+    clock.append(time.perf_counter())
+    left_img, right_img = synthetic_pairs(1, laptop_server.IMAGE_WIDTH,
+                                          laptop_server.IMAGE_HEIGHT)[0]
+    laptop_server.process_frame(calibration, disparity_handler, segmentation, left_img, right_img)
+    clock.append(time.perf_counter())
+
+    steps = ('import', 'calibration', 'setup', 'first_frame')
+    report = {step: (end - begin) * 1000 for step, begin, end in zip(steps, clock, clock[1:])}
+    report['total'] = (clock[-1] - clock[0]) * 1000
+    return report
+
+
+def startup_benchmark(calibration_folder = None):
+    '''Description: Measure the server start in fresh processes, first from the calibration
+    matrices alone, then from the bundle the first start wrote. Runs on a copy of the
+    calibration folder, an identity calibration if None.
+    Return:
+    report: {'without_bundle': {...}, 'with_bundle': {...}} in milliseconds.
+    '''
+    from load_calibration import Calibration
+    from laptop_server import IMAGE_WIDTH, IMAGE_HEIGHT
+
+    folder = tempfile.mkdtemp()
+    try:
+        if calibration_folder:
+            for file in glob.glob(os.path.join(calibration_folder, '*.npy')):
+                shutil.copy(file, folder)
+        else:
+            calibration = Calibration((IMAGE_WIDTH, IMAGE_HEIGHT))
+            calibration.load_identity()
+            calibration.save_calibration_files(folder)
+        return {'without_bundle': run_isolated(measure_startup, folder),
+                'with_bundle': run_isolated(measure_startup, folder)}
+    finally:
+        shutil.rmtree(folder)
+
+
+def compare(baseline, candidate, threshold = 0.1):
+    '''Description: Compare two benchmark reports.
+    Parameters:
+    baseline: Report of the reference configuration.
+    candidate: Report of the configuration under test.
+    threshold: Relative p50/p95 slow down above which a stage is flagged as a regression.
+    Return:
+    comparison: dict with relative changes per stage and the list of regressions.
+    '''
+    changes = {}
+    regressions = []
+    for stage in STAGES:
+        changes[stage] = {}
+        for key in ('p50_ms', 'p95_ms'):
+            before = baseline['stages'][stage][key]
+            after = candidate['stages'][stage][key]
+            change = (after - before) / before if before else 0.0
+            changes[stage][key] = change
+            if change > threshold:
+                regressions.append('{} {}'.format(stage, key))
+    return {'changes': changes,
+            'fps_change': (candidate['fps'] - baseline['fps']) / baseline['fps'],
+            'peak_rss_change_mb': candidate['peak_rss_mb'] - baseline['peak_rss_mb'],
+            'regressions': regressions}
+
+
+def load_config(filename):
+    if not filename:
+        return {}
+    with open(filename) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark the server processing offline.')
+    parser.add_argument('--images', help = 'Folder of left/right images, synthetic if omitted')
+    parser.add_argument('--calibration', help = 'Calibration folder, identity if omitted')
+    parser.add_argument('--frames', type = int, default = 100)
+    parser.add_argument('--config', help = 'JSON file overriding the default configuration')
+    parser.add_argument('--compare', help = 'JSON file of a second configuration to compare')
+    parser.add_argument('--threshold', type = float, default = 0.1,
+                        help = 'Relative slow down reported as a regression')
+    parser.add_argument('--output', help = 'File to write the JSON report to')
+    parser.add_argument('--startup', action = 'store_true',
+                        help = 'Report the time to the first processed frame instead')
+    args = parser.parse_args()
+
+    benchmark_args = (args.images, args.calibration, args.frames)
+    if args.startup:
+        report = startup_benchmark(args.calibration)
+    elif args.compare:
+        baseline = run_isolated(run_benchmark, load_config(args.config), *benchmark_args)
+        candidate = run_isolated(run_benchmark, load_config(args.compare), *benchmark_args)
+        report = {'baseline': baseline, 'candidate': candidate,
+                  'comparison': compare(baseline, candidate, args.threshold)}
+    else:
+        report = run_benchmark(load_config(args.config), *benchmark_args)
+
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    print(output)
+    if args.compare and report['comparison']['regressions']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import cv2
+import numpy as np
+
+from segmentation import SegmentationEngine
+
+
+class DepthEstimator(object):
+    '''
+    A class to turn a disparity map into the distance of the closest obstacle in every zone,
+    and a control signal with thresholds in metres. It can be used in place of a
+    SegmentationEngine.
+    Depth is looked up per disparity level in a table computed once from the disparity to
+    depth matrix Q, instead of reprojecting every pixel. The distance of a zone is a low
+    percentile of the depth of its pixels, read from a histogram of disparity levels, so
+    that a few speckles do not make the zone look occupied.
+    Methods:
+    zone_distances
+    segment
+    '''
+    def __init__(self, disp_to_depth_mat, nearest_distance = 1.0, middle_distance = 2.5,
+                 nearest_zones = 3, middle_zones = 4, percentile = 5, min_fraction = 0.02,
+                 unit = 1.0, raw = False):
+        '''
+        Parameters:
+        disp_to_depth_mat: Q matrix of the rectified camera pair, see Calibration.
+        nearest_distance: Distance in metres below which a zone is nearest.
+        middle_distance: Distance in metres below which a zone is at middle proximity.
+        nearest_zones: Number of vertical zones reported for the nearest level.
+        middle_zones: Number of vertical zones reported for the middle level.
+        percentile: Percentile of the pixel depths taken as the distance of a zone.
+        min_fraction: Fraction of a zone's pixels that must have a valid disparity,
+                      otherwise the zone is reported as free.
+        unit: Metres per unit of the calibration baseline, e.g. 0.001 for millimetres.
+        raw: Disparity maps are int16 fixed point (x16) rather than the uint8 map.
+        '''
+        self.nearest_distance = nearest_distance
+        self.middle_distance = middle_distance
+        self.nearest_zones = nearest_zones
+        self.middle_zones = middle_zones
+        self.percentile = percentile
+        self.min_fraction = min_fraction
+        self.raw = raw
+
+        if raw:
+            # Fixed point disparities clipped to [-16, 1008], offset by 16
+            pixels = (np.arange(1025) - 16) / 16.0
+        else:
+            # Centre of the disparity range mapped to every uint8 level by DisparityCreator
+            pixels = ((np.arange(256) + 0.5) * 1008 / 255 - 16) / 16.0
+        Q = np.asarray(disp_to_depth_mat, dtype = np.float64)
+        with np.errstate(divide = 'ignore'):
+            depth = Q[2, 3] / (Q[3, 2] * pixels + Q[3, 3]) * unit
+        depth[(pixels <= 0) | ~(depth > 0)] = np.inf
+        self.depth_lut = depth
+        # Levels ordered from the closest to the farthest valid depth
+        self.levels = np.argsort(depth, kind = 'stable')
+        self.levels = self.levels[np.isfinite(depth[self.levels])]
+        self.shape = None
+
+    def _allocate(self, shape):
+        self.shape = shape
+        self.nearest_bounds = SegmentationEngine._zone_bounds(shape[1], self.nearest_zones)
+        self.middle_bounds = SegmentationEngine._zone_bounds(shape[1], self.middle_zones)
+        if self.raw:
+            self.clipped = np.empty(shape, dtype = np.int16)
+
+    def _histogram(self, zone):
+        if self.raw:
+            return np.bincount(zone.ravel(), minlength = len(self.depth_lut))
+        return cv2.calcHist([zone], [0], None, [256], [0, 256]).ravel()
+
+    def _distance(self, zone):
+        '''Description: Low percentile of the depth of the pixels of a zone, inf if too few
+        pixels have a valid disparity.
+        '''
+        counts = self._histogram(zone)[self.levels]
+        valid = counts.sum()
+        if valid < self.min_fraction * zone.size or not valid:
+            return np.inf
+        index = np.searchsorted(np.cumsum(counts), valid * self.percentile / 100.0)
+        return float(self.depth_lut[self.levels[min(index, len(self.levels) - 1)]])
+
+    def zone_distances(self, disparity):
+        '''Description: Distance in metres of the closest obstacle in every zone.
+        Parameters:
+        disparity: Disparity map, uint8 or raw according to the raw parameter.
+        Return:
+        nearest, middle: Lists of distances of the nearest and middle zones, inf when free.
+        '''
+        if self.shape != disparity.shape:
+            self._allocate(disparity.shape)
+        if self.raw:
+            np.clip(disparity, -16, 1008, out = self.clipped)
+            self.clipped += 16
+            disparity = self.clipped
+        return ([self._distance(disparity[:, start:end]) for start, end in self.nearest_bounds],
+                [self._distance(disparity[:, start:end]) for start, end in self.middle_bounds])
+
+    def segment(self, disparity):
+        '''Description: Compute the control signal for a disparity map.
+        Return:
+        signal: {'nearest': [...], 'middle': [...]} zone flags, as from SegmentationEngine,
+                with the zone distances in metres in 'distances', which pack_signal sends
+                to the client in centimetres.
+        '''
+        nearest, middle = self.zone_distances(disparity)
+        return {'nearest': [1 if distance < self.nearest_distance else 0 for distance in nearest],
+                'middle': [1 if self.nearest_distance <= distance < self.middle_distance else 0
+                           for distance in middle],
+                'distances': {'nearest': nearest, 'middle': middle}}
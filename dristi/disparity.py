@@ -1,6 +1,43 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
 import numpy as np
-# from multiprocessing import process
+
+
+# uint8 value of every clipped fixed point disparity d in [-16, 1008], at index d, so that
+# negative disparities wrap around to the end of the table. Computed with the same float64
+# arithmetic as the original element-wise mapping, so the output is identical.
+DISPARITY_LUT = np.empty(1025, dtype = np.uint8)
+DISPARITY_LUT[np.arange(-16, 1009)] = (((np.arange(-16, 1009) + 16) / 1008) * 255).astype(np.uint8)
+
+# Stereo matcher parameters, besides the disparity range
+DEFAULT_SGBM = {'blockSize': 3,
+                'P1': 73,
+                'P2': 2600,
+                'disp12MaxDiff': 43, #initial 43
+                'uniquenessRatio': 10,
+                'speckleRange': 1,
+                'preFilterCap': 0,
+                'speckleWindowSize': 10,
+                'mode': 1}
+# WLS filter and disparity range used unless a profile says otherwise
+DEFAULT_PROFILE = {'Lambda': 16000, 'sigma': 7, 'num_disparities': 64, 'sgbm': {}}
+
+
+def load_profile(filename):
+    '''Description: Load a disparity profile, a JSON object with any of the keys of
+    DEFAULT_PROFILE. Missing keys take their default value.
+    Return:
+    profile: dict of DisparityCreator parameters.
+    '''
+    with open(filename) as file:
+        profile = json.load(file)
+    unknown = set(profile) - set(DEFAULT_PROFILE)
+    if unknown:
+        raise ValueError('Unknown profile keys {} in {}'.format(sorted(unknown), filename))
+    return dict(DEFAULT_PROFILE, **profile)
 
 
 class DisparityCreator(object):
@@ -9,48 +46,183 @@ class DisparityCreator(object):
     Parameters:
     Lambda: Lambda parameter for WLS filter
     sigma: SigmaColor value for WLS filter
+    concurrent: Run the left and right matchers at the same time on a thread pool
+    strips: Number of horizontal strips each image is split into, matched in parallel.
+            More than 1 approximates the full frame match, see _compute_strips.
+    overlap: Number of rows each strip is extended by on both sides before matching
+    workers: Size of the thread pool, defaults to the number of cores
+    num_disparities: Disparity search range at full resolution, a multiple of 16
+    scale: Match downscaled images, e.g. 0.5 or 0.25. Disparities are scaled back, so the
+           output uses the same range as a full resolution map.
+    upsample: Resize a downscaled disparity map back to the input size
+    roi: (top, bottom) band of rows to match, see Calibration.valid_rows. Rows outside
+         the band are set to 0 in the output.
+    raw: Return the WLS filtered int16 fixed point (x16) disparity, in full resolution units,
+         instead of the uint8 map. Used to compute metric depth.
+    sgbm: dict of cv2.StereoSGBM_create parameters overriding DEFAULT_SGBM, e.g. blockSize.
+    wls: Filter with the right disparity. Otherwise the right matcher is not run and the raw
+         left disparity is used, at about half the cost.
     Methods:
     get_disparity
+    close
+    from_profile
     '''
-    def __init__(self, Lambda, sigma):
+    def __init__(self, Lambda, sigma, concurrent = False, strips = 1, overlap = 16, workers = None,
+                 num_disparities = 64, scale = 1, upsample = True, roi = None, raw = False,
+                 sgbm = None, wls = True):
         '''Initialise stereo matcher instances for left and right images.
             Use WLS filter to remove occlusion and noise in disparity map.
+            Matchers keep internal buffers and are not safe to share between threads,
+            so every strip gets its own pair of matchers.
         '''
-        self.left_matcher = cv2.StereoSGBM_create(
-                                minDisparity = 0,
-                                numDisparities = 64,
-                                blockSize = 3,
-                                P1 = 73,
-                                P2 = 2600,
-                                disp12MaxDiff = 43, #initial 43
-                                uniquenessRatio = 10,
-                                speckleRange = 1,
-                                preFilterCap = 0,
-                                speckleWindowSize = 10,
-                                mode = 1
-                                )
+        self.strips = max(1, strips)
+        self.overlap = overlap
+        self.scale = scale
+        self.upsample = upsample
+        self.roi = roi
+        self.raw = raw
+        self.wls = wls
+        # Disparities found on downscaled images are multiplied back by this factor
+        self.disparity_factor = int(round(1 / scale))
+        self.num_disparities = max(16, int(num_disparities * scale) // 16 * 16)
+        self.sgbm = dict(DEFAULT_SGBM, **(sgbm or {}))
+        self.left_matchers = [self._create_left_matcher() for _ in range(self.strips)]
+        self.right_matchers = [cv2.ximgproc.createRightMatcher(matcher)
+                               for matcher in self.left_matchers]
+        self.left_matcher = self.left_matchers[0]
+        self.right_matcher = self.right_matchers[0]
 
         self.wls_filter = cv2.ximgproc.createDisparityWLSFilter(self.left_matcher)
-        self.right_matcher = cv2.ximgproc.createRightMatcher(self.left_matcher)
         self.wls_filter.setLambda(Lambda)
         self.wls_filter.setSigmaColor(sigma)
 
+        self.kernel = np.ones((3, 3), np.uint8)
+        self.clipped = None
+        self.mapped = None
+
+        self.executor = None
+        if concurrent or self.strips > 1:
+            self.executor = ThreadPoolExecutor(max_workers = workers or os.cpu_count())
+
+    def _create_left_matcher(self):
+        return cv2.StereoSGBM_create(minDisparity = 0, numDisparities = self.num_disparities,
+                                     **self.sgbm)
+
+    @classmethod
+    def from_profile(cls, filename, **kwargs):
+        '''Create an instance from a profile file written by tuning.py.
+        Parameters:
+        filename: JSON profile, see load_profile.
+        kwargs: Further parameters, e.g. concurrent or scale, not set by the profile.
+        '''
+        return cls(**dict(load_profile(filename), **kwargs))
+
     def get_disparity(self, left_img, right_img):
         '''Get disparity map for corresponding left and right images.
         Parameters:
         left_img: Left image
         right_img: Right image
         '''
-        left_disparity = self.left_matcher.compute(left_img, right_img)
-        right_disparity = self.right_matcher.compute(right_img, left_img)
-        filtered_disparity = self.wls_filter.filter(left_disparity, left_img, None, right_disparity)
-
-        filtered_disparity[filtered_disparity > 1008] = 1008
-        filtered_disparity[filtered_disparity < -16] = -16
-        filtered_disparity = (((filtered_disparity + 16)/ 1008) * 255).astype(np.uint8)
-
-        kernel = np.ones((3,3),np.uint8)
-        disparity = cv2.morphologyEx(filtered_disparity,cv2.MORPH_OPEN,kernel, iterations = 2)
-        coloured_disparity = cv2.applyColorMap((disparity).astype(np.uint8), cv2.COLORMAP_JET)
-        cv2.imshow('disparity', coloured_disparity)
+        full_shape = left_img.shape[:2]
+        if self.roi is not None:
+            top, bottom = self.roi
+            left_img, right_img = left_img[top:bottom], right_img[top:bottom]
+        band_shape = left_img.shape[:2]
+        if self.scale != 1:
+            left_img = cv2.resize(left_img, None, fx = self.scale, fy = self.scale,
+                                  interpolation = cv2.INTER_AREA)
+            right_img = cv2.resize(right_img, None, fx = self.scale, fy = self.scale,
+                                   interpolation = cv2.INTER_AREA)
+
+        left_disparity, right_disparity = self.compute_matches(left_img, right_img)
+        if self.wls:
+            filtered_disparity = self.wls_filter.filter(left_disparity, left_img, None,
+                                                        right_disparity)
+        else:
+            filtered_disparity = left_disparity
+        if self.disparity_factor != 1:
+            filtered_disparity *= self.disparity_factor
+
+        if self.raw:
+            disparity = filtered_disparity
+        else:
+            disparity = self.to_uint8(filtered_disparity)
+        if self.scale != 1 and self.upsample:
+            disparity = cv2.resize(disparity, band_shape[::-1], interpolation = cv2.INTER_NEAREST)
+        if self.roi is not None and (self.scale == 1 or self.upsample):
+            full = np.zeros(full_shape, dtype = disparity.dtype)
+            full[top:bottom] = disparity
+            disparity = full
         return disparity
+
+    def to_uint8(self, filtered_disparity):
+        '''Map a fixed point disparity to the uint8 map and clean it up with a morphological
+        open. Clipping to [-16, 1008] and the lookup reuse buffers; only the returned map is
+        allocated, as callers may hold on to it.
+        '''
+        if self.clipped is None or self.clipped.shape != filtered_disparity.shape:
+            self.clipped = np.empty(filtered_disparity.shape, dtype = np.int16)
+            self.mapped = np.empty(filtered_disparity.shape, dtype = np.uint8)
+        np.clip(filtered_disparity, -16, 1008, out = self.clipped)
+        # Negative values index the end of the table, where -16..-1 are stored
+        np.take(DISPARITY_LUT, self.clipped, out = self.mapped)
+        return cv2.morphologyEx(self.mapped, cv2.MORPH_OPEN, self.kernel, iterations = 2)
+
+    def compute_matches(self, left_img, right_img):
+        '''Compute the raw left and right disparities, concurrently if a thread pool is available.
+        Parameters:
+        left_img: Left image
+        right_img: Right image
+        Return:
+        left_disparity, right_disparity: Fixed point (x16) disparity maps, the right one is
+                                         None without the WLS filter.
+        '''
+        if self.executor is None or (not self.wls and self.strips == 1):
+            return (self.left_matcher.compute(left_img, right_img),
+                    self.right_matcher.compute(right_img, left_img) if self.wls else None)
+        if self.strips == 1:
+            left_future = self.executor.submit(self.left_matcher.compute, left_img, right_img)
+            right_future = self.executor.submit(self.right_matcher.compute, right_img, left_img)
+            return left_future.result(), right_future.result()
+        return self._compute_strips(left_img, right_img)
+
+    def _compute_strips(self, left_img, right_img):
+        '''Split the images into overlapping horizontal strips, match every strip in both
+        directions in parallel and stitch the central rows of each strip back together.
+        This is an approximation of the full frame match: semi-global paths are cut at the
+        end of the overlap, and in the default 8 direction mode every vertical and diagonal
+        path is, so differences are not limited to rows near strip borders. With 4 strips,
+        about 5% of raw disparities differ, spread over most rows, and after WLS filtering
+        and normalisation about 25% of the uint8 map differs by 1 to 2 levels.
+        '''
+        height = left_img.shape[0]
+        bounds = np.linspace(0, height, self.strips + 1).astype(int)
+        left_disparity = np.empty(left_img.shape[:2], dtype = np.int16)
+        right_disparity = np.empty(left_img.shape[:2], dtype = np.int16) if self.wls else None
+
+        futures = []
+        for index in range(self.strips):
+            start, end = bounds[index], bounds[index + 1]
+            top = max(0, start - self.overlap)
+            bottom = min(height, end + self.overlap)
+            left_strip = left_img[top:bottom]
+            right_strip = right_img[top:bottom]
+            futures.append((start, end, top,
+                            self.executor.submit(self.left_matchers[index].compute,
+                                                 left_strip, right_strip),
+                            self.executor.submit(self.right_matchers[index].compute,
+                                                 right_strip, left_strip) if self.wls else None))
+
+        for start, end, top, left_future, right_future in futures:
+            left_disparity[start:end] = left_future.result()[start - top:end - top]
+            if right_future is not None:
+                right_disparity[start:end] = right_future.result()[start - top:end - top]
+
+        return left_disparity, right_disparity
+
+    def close(self):
+        '''Shut down the thread pool, if any.
+        '''
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,6 +1,10 @@
 import os
+import re
 import sys
-from threading import Thread
+import time
+from collections import deque
+from threading import Thread, Condition
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 
@@ -9,58 +13,131 @@ import cv2
 class CaptureImage(object):
     '''A class to capture images from webcam in a separate thread. It allows
     access to only the recent most image pairs.
+    Both cameras are grabbed back to back before either frame is decoded, so the two
+    images of a pair are as close in time as possible. Pairs are decoded into a ring of
+    buffers and published with a sequence number and timestamp, so load_images never
+    returns a torn pair, nor the same pair twice.
     Methods defined here:
     @public: start()
              stop()
              load_images()
-    @private: _capture_frames()
+    @private: _configure()
+              _capture_frames()
     '''
-    def __init__(self, LEFT_CAM, RIGHT_CAM):
+    def __init__(self, LEFT_CAM, RIGHT_CAM, width = None, height = None, fps = None,
+                 buffer_size = 1, fourcc = None):
         '''
         Description: Initialise 2 webcams to capture images. Take 20 images to be discared,
         so that a small amount of time is given for webcams to adjust
         Parameters: LEFT_CAM - Port number corresponding to left webcam
                  RIGHT_CAM - Port number corresponding to right webcam
+                 width, height, fps - Requested resolution and frame rate, camera default if None
+                 buffer_size - Number of frames queued by the driver, 1 keeps the latest only
+                 fourcc - Requested pixel format, camera default if None. With 'GREY' or
+                          'YUYV' frames are returned unconverted, single channel or with
+                          the luma in the first channel.
         '''
         self.left_capture = cv2.VideoCapture(LEFT_CAM)
         self.right_capture = cv2.VideoCapture(RIGHT_CAM)
 
         if not self.left_capture.isOpened():
-            self.left_capture.open()
+            self.left_capture.open(LEFT_CAM)
         if not self.right_capture.isOpened():
-            self.right_capture.open()
+            self.right_capture.open(RIGHT_CAM)
+        for capture in (self.left_capture, self.right_capture):
+            self._configure(capture, width, height, fps, buffer_size, fourcc)
 
         self.stopped = False
 
         for _ in range(20):
-            ret, self.left_frame = self.left_capture.read()
-            ret, self.right_frame = self.right_capture.read()
+            self.left_capture.grab()
+            self.right_capture.grab()
+
+        # The consumer may still be using the pair it was given last, and the latest pair
+        # must stay readable, so the capture thread needs a third pair to decode into.
+        self.buffers = [[None, None] for _ in range(3)]
+        self.condition = Condition()
+        self.latest = None
+        self.reading = None
+        self.sequence = 0
+        self.timestamp = None
+        self.read_sequence = 0
+        self.read_timestamp = None
+        self.skipped = 0
+
+    @staticmethod
+    def _configure(capture, width, height, fps, buffer_size, fourcc):
+        '''Description: Request capture properties. Drivers silently ignore unsupported ones.
+        '''
+        if fourcc is not None:
+            capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+            if fourcc in ('GREY', 'YUYV'):
+                capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        if width is not None:
+            capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps is not None:
+            capture.set(cv2.CAP_PROP_FPS, fps)
+        if buffer_size is not None:
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
 
     def start(self):
         '''Description: Start a thread to capture images
         '''
         self.t = Thread(target= self._capture_frames)
-        self.t.setDaemon(True)
+        self.t.daemon = True
         self.t.start()
 
     def _capture_frames(self):
         '''Description: A method for thread to loop while capturing left and right images
         from webcams. The recent most image pairs are stored.
         '''
-        while True:
-            if self.stopped :
-                self.t.stop()
-                self.left_capture.close()
-                self.right_capture.close()
-                return
-            ret, self.left_frame = self.left_capture.read()
-            ret, self.right_frame = self.right_capture.read()
-
-
-    def load_images(self):
-        '''Description: Returns the recent most left and right image pairs.
+        while not self.stopped:
+            # grab() blocks until the camera delivers a frame, so the loop does not spin
+            grabbed = self.left_capture.grab() and self.right_capture.grab()
+            timestamp = time.time()
+            if not grabbed:
+                time.sleep(0.01)
+                continue
+
+            with self.condition:
+                index = next(index for index in range(len(self.buffers))
+                             if index != self.latest and index != self.reading)
+            pair = self.buffers[index]
+            left_ok, pair[0] = self.left_capture.retrieve(pair[0])
+            right_ok, pair[1] = self.right_capture.retrieve(pair[1])
+            if not (left_ok and right_ok):
+                continue
+
+            with self.condition:
+                if self.sequence > self.read_sequence:
+                    self.skipped += 1
+                self.latest = index
+                self.sequence += 1
+                self.timestamp = timestamp
+                self.condition.notify_all()
+
+        self.left_capture.release()
+        self.right_capture.release()
+
+    def load_images(self, timeout = 1.0):
+        '''Description: Returns the recent most left and right image pairs, waiting for a
+        pair newer than the previous one. The pair stays valid until the next call.
+        The sequence number and capture time of the pair are kept in read_sequence and
+        read_timestamp.
+        Parameters: timeout - Seconds to wait for a new pair before returning the latest one.
+        Returns: (None, None) if no pair has been captured yet, e.g. while a camera starts.
         '''
-        return self.left_frame, self.right_frame
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > self.read_sequence, timeout)
+            if self.latest is None:
+                return None, None
+            self.reading = self.latest
+            self.read_sequence = self.sequence
+            self.read_timestamp = self.timestamp
+            left_frame, right_frame = self.buffers[self.reading]
+        return left_frame, right_frame
 
     def stop(self):
         '''Description: Assign a thread termination indicating variable to True.
@@ -71,47 +148,95 @@ class CaptureImage(object):
 class ReadImages(object):
     '''
     A class to load left and right image pairs from the given folder.
+    Pairs are indexed once, in numerical order of their sequence number, and decoded ahead
+    of time on a thread pool. At most prefetch pairs are held in memory at once.
     Methods defined here:
     @public: load_images()
+             read()
              start()
              stop()
+    @private: _fill()
     '''
-    def __init__(self, folder):
+    def __init__(self, folder, grayscale = False, prefetch = 4, workers = 2):
         '''Description: Initiales the left and right image file names present in folder.
         Parameters: folder - Name of the folder which contains images in the
                           format left<sequence_number> and
                           right<sequence_number>.
+                 grayscale - Decode directly to single channel images.
+                 prefetch - Number of pairs decoded ahead, 0 decodes on demand.
+                 workers - Number of decoding threads.
+        '''
+        files = {}
+        for file in os.listdir(folder):
+            for side in ('left', 'right'):
+                if file.startswith(side):
+                    files.setdefault(file[len(side):], {})[side] = os.path.join(folder, file)
+        sequence = sorted((key for key, sides in files.items() if len(sides) == 2),
+                          key = _sequence_key)
+        self.pairs = [(files[key]['left'], files[key]['right']) for key in sequence]
+
+        self.flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+        self.prefetch = prefetch
+        self.position = 0
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers = workers) if prefetch else None
+
+    def __len__(self):
+        '''Description: Number of pairs not loaded yet.
+        '''
+        return len(self.pairs) - self.position + len(self.pending)
+
+    def _read(self, files):
+        return [cv2.imread(file, self.flags) for file in files]
+
+    def read(self, index):
+        '''Description: Decode the pair at a given position of the index, independently of
+        load_images, e.g. to share the pairs of a folder between processes.
         '''
-        left_images = [file for file in os.listdir(folder) \
-                                if file.startswith('left')]
-        right_images = [file for file in os.listdir(folder) \
-                                if file.startswith('right')]
-        self.images_folder = []
-        for file in left_images:
-            string = 'right'+ file[4:]
-            if string in right_images:
-                self.images_folder.append(os.path.join(folder, file))
-                self.images_folder.append(os.path.join(folder, string))
+        return self._read(self.pairs[index])
+
+    def _fill(self):
+        '''Description: Queue decoding of the next pairs, up to prefetch pairs ahead.
+        '''
+        while len(self.pending) < self.prefetch and self.position < len(self.pairs):
+            self.pending.append(self.executor.submit(self._read, self.pairs[self.position]))
+            self.position += 1
 
     def load_images(self):
         '''Description: Loads images 2 at a time corresponding to left and right images.
         '''
-        if self.images_folder:
-            left_frame, right_frame = [cv2.imread(file) \
-                                        for file in self.images_folder[:2]]
-            self.images_folder = self.images_folder[2:]
-
+        if self.prefetch:
+            self._fill()
+            if self.pending:
+                left_frame, right_frame = self.pending.popleft().result()
+                self._fill()
+                return left_frame, right_frame
+        elif self.position < len(self.pairs):
+            left_frame, right_frame = self._read(self.pairs[self.position])
+            self.position += 1
             return left_frame, right_frame
-
-        else:
-            sys.exit()
+        sys.exit()
 
     def start(self):
         '''Description: A method just to discard initial 3 image pairs.
         '''
-        self.images_folder = self.images_folder[6:]
+        for _ in range(3):
+            if self.pending:
+                self.pending.popleft().cancel()
+            elif self.position < len(self.pairs):
+                self.position += 1
 
     def stop(self):
-        '''Description: Dummy method for compatibility.
+        '''Description: Stop the decoding threads.
         '''
-        return
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait = False)
+
+
+def _sequence_key(key):
+    '''Description: Sort key ordering sequence numbers numerically, so that 10 comes after 9.
+    '''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', key)]
@@ -4,13 +4,24 @@ Description: A script to run laptop as server for collecting images from a Raspb
 '''
 
 
-import sys, struct, os, pickle, socket
+import sys, os, socket, atexit
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import numpy as np
-import cv2
 
 from load_calibration import Calibration
-from disparity import DisparityCreator
+from disparity import DEFAULT_PROFILE, DisparityCreator, load_profile
+from pipeline import Pipeline, Frame
+from segmentation import SegmentationEngine
+from depth import DepthEstimator
+from viewer import DebugViewer
+from temporal import TemporalDisparity
+from metrics import FrameMetrics, MetricsServer
+from recording import SessionRecorder
+from adaptive import AdaptiveDisparity
+from protocol import ENCODING_RAW, FrameDecoder, accept_encoding, pack_signal
 
 # Mention the folder which contains calibration parameters
 CALIBRATION_FOLDER = 'calibration_parameters'
@@ -25,6 +36,87 @@ NEAREST_HIGHER_THRESH = 255
 MIDDLE_LOWER_THRESH = 150
 MIDDLE_HIGHER_THRESH = 180
 
+# Decide proximity from metric depth, computed with the calibration's disparity to depth
+# matrix, instead of the disparity thresholds above. Distances are in metres.
+DEPTH_MODE = False
+NEAREST_DISTANCE = 1.0
+MIDDLE_DISTANCE = 2.5
+# Percentile of the pixel depths taken as the distance of a zone
+DEPTH_PERCENTILE = 5
+# Metres per unit of the calibration baseline, e.g. 0.001 if calibrated in millimetres
+DEPTH_UNIT = 1.0
+
+# Run the left and right matchers concurrently, optionally on overlapping horizontal strips.
+# Strips approximate the full frame match: with 4, about a quarter of the disparity map differs
+# by 1 to 2 levels, see DisparityCreator._compute_strips.
+DISPARITY_CONCURRENT = True
+DISPARITY_STRIPS = 1
+# Rectify the left and right images in parallel
+PREPROCESS_PARALLEL = False
+REMAP_EXECUTOR = None
+
+# JSON disparity profile written by tuning.py, e.g. 'profile.json', None for the defaults
+DISPARITY_PROFILE = None
+
+# Compute disparity in this many worker processes, frames being passed through shared memory.
+# The workers are shared by all clients, 0 computes disparity in the server process.
+DISPARITY_PROCESSES = 0
+DISPARITY_BACKEND = None
+
+# Match downscaled images (0.5 or 0.25) and only the band of rows valid in both images
+DISPARITY_SCALE = 1
+DISPARITY_VALID_ROWS_ONLY = False
+
+# Reuse the previous disparity and signal when consecutive frames barely change,
+# and recompute only the changed strips otherwise. Not combined with DISPARITY_VALID_ROWS_ONLY.
+TEMPORAL_MODE = False
+TEMPORAL_THRESHOLD = 2.0
+# Weight of the newest disparity in the temporal moving average, 0 disables smoothing
+TEMPORAL_SMOOTHING = 0.0
+
+# Per frame latency instrumentation, served as text on localhost:METRICS_PORT
+METRICS_ENABLED = True
+METRICS_PORT = 8001
+METRICS_LOG_INTERVAL = 30
+# Frames answered later than this many seconds after being received count as late
+FRAME_DEADLINE = 0.2
+# Trade disparity quality for time when frames miss FRAME_DEADLINE: skip the WLS filter,
+# shorten the search, downscale, then drop frames, see adaptive.py. Sequential loop only,
+# not combined with TEMPORAL_MODE or DISPARITY_PROCESSES, which check_settings rejects.
+ADAPTIVE_QUALITY = False
+
+# Skip all visualisation. Otherwise frames are shown by a throttled viewer thread.
+HEADLESS = True
+VIEWER_FPS = 10
+
+# Serve frames with the asyncio protocol, keeping several frames in flight
+ASYNC_MODE = False
+
+# Serve several clients at once with ASYNC_MODE. Every client has its own calibration,
+# disparity and temporal state, and frames of all clients share MULTI_CLIENT_WORKERS threads.
+MULTI_CLIENT_MODE = False
+MULTI_CLIENT_WORKERS = os.cpu_count()
+# Calibration folder of every client host, others use CALIBRATION_FOLDER
+CLIENT_CALIBRATION_FOLDERS = {}
+
+# Run receive, rectify, disparity, segment and send as separate threaded stages. Stages only
+# overlap with several frames in flight, i.e. with the client in ASYNC_MODE: a lock-step
+# client has a single frame in the pipeline at any time.
+PIPELINE_MODE = False
+# Capacity of the queues joining the pipeline stages
+PIPELINE_QUEUE_SIZE = 2
+# Frames older than this many seconds are dropped instead of being processed
+PIPELINE_MAX_AGE = 0.5
+# Seconds between two throughput reports of the pipeline
+PIPELINE_REPORT_INTERVAL = 10
+
+# Record every received frame and the signal sent back to this session file, e.g.
+# 'session.drs', for replay with recording.py. Not available in ASYNC_MODE.
+RECORD_SESSION = None
+
+# Number of frames between two reports of wire size and decoding cost
+TRANSPORT_REPORT_INTERVAL = 100
+
 
 def initialise_connection():
     '''
@@ -42,40 +134,92 @@ def initialise_connection():
     print('Connection accepted...')
     return connection, server_socket
 
-def recieve(connection):
+class FrameReceiver(object):
+    '''A class to receive images into a ring of preallocated buffers, without copying.
+    Returned images are views into the buffers, and stay valid until the ring wraps around,
+    i.e. for the next (buffers - 1) calls to recieve. Without a ring, buffers are taken from
+    a free list and stay valid until given back with release.
+    Methods:
+    recieve
+    release
     '''
-    Description: A simple protocol for receiving images.
-    First obtain the size of images, then receive a single concatenated image, which is later split appropriately
-    Parameters:
-    connection: Connection object received from initialisation function.
-    Returns:
-    left_img, right_img : Left and right images captured from webcam connected to Raspberry Pi client.
-    '''
-    data_length = struct.unpack('<L', connection.recv(struct.calcsize('<L')))[0]
-    if not data_length:
-        sys.exit()
-    data = b''
-    length = 0
-    while length < data_length:
-        chunk = connection.recv(int(data_length/2))
-        length += len(chunk)
-        data += chunk
-    data = np.fromstring(data, dtype = np.uint8)
-    data = np.reshape(data, (-1, IMAGE_WIDTH * 2))
-
-    left_img, right_img = np.array_split(data, 2, axis = 1)
-
-    return left_img, right_img
-
-def send(connection, signal):
+    def __init__(self, connection, encoding = ENCODING_RAW, buffers = 1, metrics = None):
+        '''
+        Parameters:
+        connection: Connection object received from initialisation function.
+        encoding: Frame encoding negotiated with the client.
+        buffers: Number of frame buffers to cycle through, None for a free list.
+        metrics: Optional FrameMetrics. A timer for the received frame is then kept in timer.
+        '''
+        self.connection = connection
+        self.metrics = metrics
+        self.timer = None
+        self.decoder = FrameDecoder(encoding)
+        self.buffers = None
+        self.free = []
+        if buffers is not None:
+            self.buffers = [np.empty((IMAGE_HEIGHT, IMAGE_WIDTH * 2), dtype = np.uint8)
+                            for _ in range(buffers)]
+        self.index = 0
+        self.buffer = None
+        self.frame_id = None
+
+    def recieve(self):
+        '''
+        Description: A simple protocol for receiving images.
+        First obtain the frame header, then receive and decode a single concatenated image
+        into the next buffer of the ring.
+        Returns:
+        left_img, right_img : Views of the left and right halves of the received image.
+        '''
+        width, height, self.frame_id, length = self.decoder.recieve_header(self.connection)
+        if not length:
+            sys.exit()
+        if self.metrics is not None:
+            self.timer = self.metrics.start_frame(self.frame_id, self.decoder.capture_time)
+
+        if self.buffers is None:
+            buffer = self.free.pop() if self.free else None
+            if buffer is None or buffer.shape != (height, width):
+                buffer = np.empty((height, width), dtype = np.uint8)
+        else:
+            buffer = self.buffers[self.index]
+            if buffer.shape != (height, width):
+                buffer = np.empty((height, width), dtype = np.uint8)
+                self.buffers[self.index] = buffer
+            self.index = (self.index + 1) % len(self.buffers)
+        self.buffer = buffer
+
+        self.decoder.recieve_into(self.connection, length, buffer)
+        if self.timer is not None:
+            self.timer.mark('receive')
+        return buffer[:, :width // 2], buffer[:, width // 2:]
+
+    def release(self, buffer):
+        '''Description: Give back the buffer of a received frame which is no longer used.
+        Only without a ring.
+        '''
+        self.free.append(buffer)
+
+
+def send(connection, frame_id, signal, fallback = False):
     '''Description: A simple protocol to send control signals.
-    First send the size of the signal, then send the serialised signal.
+    The signal is sent as a fixed size record tagged with the frame id it answers.
     Parameters:
     connection: Connection object received from initialisation function.
+    frame_id: Sequence number of the frame the signal was computed from.
     signal: The signal to be sent to client.
+    fallback: The signal is the last known one, as the frame was dropped.
+    '''
+    connection.sendall(pack_signal(frame_id, signal, fallback))
+
+def get_remap_executor():
+    '''Description: Thread pool rectifying the right image while the caller rectifies the left.
     '''
-    connection.send(struct.pack('<I', sys.getsizeof(signal)))
-    connection.send(pickle.dumps(signal))
+    global REMAP_EXECUTOR
+    if REMAP_EXECUTOR is None:
+        REMAP_EXECUTOR = ThreadPoolExecutor(max_workers = 1)
+    return REMAP_EXECUTOR
 
 def preprocess(calibration, left_img, right_img):
     '''Description: Preprocess the images to remove distortion and rectify them.
@@ -84,132 +228,322 @@ def preprocess(calibration, left_img, right_img):
     left_img: Left image received.
     right_img: Right image received.
     '''
-    undistorted_left = cv2.remap(left_img,calibration.undistortion_map['left'],
-                                calibration.rectification_map['left'],
-                                cv2.INTER_LINEAR)
-    undistorted_right = cv2.remap(right_img,calibration.undistortion_map['right'],
-                                 calibration.rectification_map['right'],
-                                 cv2.INTER_LINEAR)
+    if PREPROCESS_PARALLEL:
+        right_future = get_remap_executor().submit(calibration.remap, 'right', right_img)
+        undistorted_left = calibration.remap('left', left_img)
+        return undistorted_left, right_future.result()
 
+    undistorted_left = calibration.remap('left', left_img)
+    undistorted_right = calibration.remap('right', right_img)
 
     return undistorted_left,undistorted_right
 
-def apply_thresholds(disparity):
-    '''Description: Apply thresholds to grayscale image to segment objects present at 2 proximity levels.
-    Parameters:
-    disparity: disparity map
-    Return:
-    middle: Image with objects present at mid-level proximity
-    nearest: Image with objects of nearest proximity
-    '''
-    nearest = np.full(disparity.shape, 255, dtype = np.float32)
-    middle = np.full(disparity.shape, 255, dtype=np.float32)
-
-    nearest[disparity > NEAREST_HIGHER_THRESH] = 0
-    nearest[disparity < NEAREST_LOWER_THRESH] = 0
-
-    middle[disparity > MIDDLE_HIGHER_THRESH] = 0
-    middle[disparity < MIDDLE_LOWER_THRESH] = 0
-
-    kernel = np.ones((5,5),np.uint8)
-    nearest = cv2.morphologyEx(nearest, cv2.MORPH_OPEN, kernel)
-    nearest = cv2.morphologyEx(nearest, cv2.MORPH_CLOSE, kernel)
-
-    middle = cv2.morphologyEx(middle, cv2.MORPH_OPEN, kernel)
-    middle = cv2.morphologyEx(middle, cv2.MORPH_CLOSE, kernel)
-
-    return nearest, middle
-
-def find_centroid(contour):
-    '''Description: Finds centroid of contour.
-    Parameters:
-    contour: The contour to find the centroid of.
-    Return:
-    (cx, cy): x, y tuple of centroid if centroid is present, else None
+def create_segmentation(calibration = None):
+    '''Description: Create a segmentation engine using the proximity thresholds, or a depth
+    estimator using the distance thresholds in DEPTH_MODE, which requires the calibration.
+    Each thread computing signals needs its own engine, as it reuses its buffers.
     '''
-    M = cv2.moments(contour)
-    try:
-        cx = int(M['m10']/M['m00'])
-        cy = int(M['m01']/M['m00'])
-        return (cx, cy)
-    except:
-        return None
-
-def find_locations(img):
-    '''Description: Finding contours and their centroids of image portion.
-    Parameters:
-    img : binary image portion
-    Return:
-    locations: list of centroids of contour regions if significantly big.
+    if DEPTH_MODE:
+        return DepthEstimator(calibration.disp_to_depth_mat, NEAREST_DISTANCE, MIDDLE_DISTANCE,
+                              percentile = DEPTH_PERCENTILE, unit = DEPTH_UNIT)
+    return SegmentationEngine((NEAREST_LOWER_THRESH, NEAREST_HIGHER_THRESH),
+                              (MIDDLE_LOWER_THRESH, MIDDLE_HIGHER_THRESH))
+
+def segment(disparity_handler, segmentation, disparity):
+    '''Description: Compute the control signal for a disparity map, reusing the previous
+    signal when the temporal handler found the frame unchanged.
     '''
-    contour_img, contours, _ = cv2.findContours(img.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    contours = [contour for contour in contours
-                if cv2.contourArea(contour) >
-                (img.shape[0]*img.shape[1]/3)] # if countour area is > (1/3)rd of img portion
-    locations = [find_centroid(contour) for contour in contours]
-    locations = [loc for loc in locations if not loc == None]
+    if isinstance(disparity_handler, TemporalDisparity):
+        return disparity_handler.segment(segmentation, disparity)
+    return segmentation.segment(disparity)
 
-    return locations
-
-
-def apply_segmentation(nearest, middle):
-    '''Description: Apply segmentation to nearest and middle images after dividing each into 3 parts.
-    Find appropriate control signal.
+def process_frame(calibration, disparity_handler, segmentation, left_img, right_img,
+                  viewer = None, timer = None):
+    '''Description: Compute the control signal for a single pair of received images.
     Parameters:
-    nearest: Image with objects of nearest proximity
-    middle: Image with objects present at mid-level proximity
+    calibration: Calibration object containing all undistortion maps.
+    disparity_handler: DisparityCreator or TemporalDisparity instance.
+    segmentation: SegmentationEngine instance.
+    left_img: Left image received.
+    right_img: Right image received.
+    viewer: Optional DebugViewer.
+    timer: Optional FrameTimer, marked after every stage.
     Return:
     signal: Control signal.
     '''
-    signal = {'nearest': [], 'middle':[]}
-    nearest_parts = np.array_split(nearest, 3, axis = 1)
-
-    for each in nearest_parts:
-        loc = find_locations(each)
-        if loc:
-            signal['nearest'].append(1)
-        else:
-            signal['nearest'].append(0)
+    left_img, right_img = preprocess(calibration, left_img, right_img)
+    if timer is not None:
+        timer.mark('preprocess')
+    disparity = disparity_handler.get_disparity(left_img, right_img)
+    if timer is not None:
+        timer.mark('disparity')
+    if viewer is not None:
+        viewer.show(left_img, right_img, disparity)
+    signal = segment(disparity_handler, segmentation, disparity)
+    if timer is not None:
+        timer.mark('segment')
+    return signal
 
-    middle_parts = np.array_split(middle, 4, axis = 1)
-    for each in middle_parts:
-        loc = find_locations(each)
-        if loc:
-            signal['middle'].append(1)
-        else:
-            signal['middle'].append(0)
+def run_pipeline(calibration, disparity_handler, segmentation, connection, encoding,
+                 viewer = None, metrics = None, recorder = None):
+    '''Description: Process frames as a pipeline of threaded stages joined by bounded queues.
+    Stages overlap only if the client keeps several frames in flight, see AsyncClient.
+    Stale frames are dropped, but the client is still answered with the last known signal,
+    tagged as a fallback, so that it never waits for a reply which will not come and does
+    not take it for a newer result than the answers to older frames still in the pipeline.
+    Parameters:
+    calibration: Calibration object containing all undistortion maps.
+    disparity_handler: DisparityCreator instance.
+    segmentation: SegmentationEngine instance.
+    connection: Connection object received from initialisation function.
+    encoding: Frame encoding negotiated with the client.
+    viewer: Optional DebugViewer.
+    metrics: Optional FrameMetrics.
+    recorder: Optional SessionRecorder.
+    '''
+    send_lock = Lock()
+    state = {'signal': {'nearest': [0, 0, 0], 'middle': [0, 0, 0, 0]}}
+
+    # Received images are views into the receiver's buffers. A buffer is given back once its
+    # frame is rectified or dropped, however many frames the client keeps in flight.
+    receiver = FrameReceiver(connection, encoding, buffers = None, metrics = metrics)
+
+    def receive_stage():
+        left_img, right_img = receiver.recieve()
+        if recorder is not None:
+            recorder.write_frame(receiver.frame_id, left_img, right_img)
+        frame = Frame(receiver.frame_id, left_img, right_img)
+        frame.timer = receiver.timer
+        frame.buffer = receiver.buffer
+        return frame
+
+    def rectify_stage(frame):
+        frame.left_img, frame.right_img = preprocess(calibration, frame.left_img, frame.right_img)
+        receiver.release(frame.buffer)
+        frame.buffer = None
+        if frame.timer is not None:
+            frame.timer.mark('preprocess')
+        return frame
+
+    def disparity_stage(frame):
+        frame.disparity = disparity_handler.get_disparity(frame.left_img, frame.right_img)
+        if frame.timer is not None:
+            frame.timer.mark('disparity')
+        return frame
+
+    def segment_stage(frame):
+        frame.signal = segment(disparity_handler, segmentation, frame.disparity)
+        if frame.timer is not None:
+            frame.timer.mark('segment')
+        if viewer is not None:
+            viewer.show(frame.left_img, frame.right_img, frame.disparity)
+        return frame
+
+    def send_stage(frame):
+        with send_lock:
+            state['signal'] = frame.signal
+            send(connection, frame.frame_id, frame.signal)
+        if recorder is not None:
+            recorder.write_signal(frame.frame_id, frame.signal)
+        if metrics is not None:
+            frame.timer.mark('send')
+            metrics.finish(frame.timer)
+        return frame
+
+    def on_drop(frame):
+        if frame.buffer is not None:
+            receiver.release(frame.buffer)
+            frame.buffer = None
+        with send_lock:
+            send(connection, frame.frame_id, state['signal'], fallback = True)
+            signal = state['signal']
+        if recorder is not None:
+            recorder.write_signal(frame.frame_id, signal, fallback = True)
+        if metrics is not None:
+            metrics.drop(frame.timer)
+
+    pipeline = Pipeline(queue_size = PIPELINE_QUEUE_SIZE, max_age = PIPELINE_MAX_AGE,
+                        on_drop = on_drop)
+    pipeline.add_stage('receive', receive_stage)
+    pipeline.add_stage('rectify', rectify_stage)
+    pipeline.add_stage('disparity', disparity_stage)
+    pipeline.add_stage('segment', segment_stage)
+    pipeline.add_stage('send', send_stage)
+    pipeline.start()
+    try:
+        pipeline.join(report_interval = PIPELINE_REPORT_INTERVAL)
+    finally:
+        pipeline.stop()
+        pipeline.print_report()
+        print('Transport: {}'.format(receiver.decoder.stats))
 
-    return signal
 
+def serve(calibration, disparity_handler, segmentation, connection, encoding,
+          viewer = None, metrics = None, recorder = None):
+    '''Description: Process frames one at a time, in the order they are received.
+    Parameters are the same as for run_pipeline.
+    '''
+    receiver = FrameReceiver(connection, encoding, metrics = metrics)
+    adaptive = disparity_handler if isinstance(disparity_handler, AdaptiveDisparity) else None
+    signal = {'nearest': [0, 0, 0], 'middle': [0, 0, 0, 0]}
+    while True:
+        left_img, right_img = receiver.recieve()
+        if recorder is not None:
+            recorder.write_frame(receiver.frame_id, left_img, right_img)
+        if receiver.frame_id % TRANSPORT_REPORT_INTERVAL == 0:
+            print('Transport: {}'.format(receiver.decoder.stats))
+            if TEMPORAL_MODE:
+                print('Temporal reuse: {}'.format(disparity_handler.report()))
+        # A dropped frame is answered with the last signal, the client waits for every reply
+        process = adaptive is None or adaptive.begin(receiver.decoder.capture_time)
+        if process:
+            signal = process_frame(calibration, disparity_handler, segmentation,
+                                   left_img, right_img, viewer, receiver.timer)
+        send(connection, receiver.frame_id, signal, fallback = not process)
+        if adaptive is not None:
+            adaptive.finish()
+        if recorder is not None:
+            recorder.write_signal(receiver.frame_id, signal, fallback = not process)
+        if metrics is not None and not process:
+            metrics.drop(receiver.timer)
+        elif metrics is not None:
+            receiver.timer.mark('send')
+            metrics.finish(receiver.timer)
+
+@lru_cache(maxsize = None)
+def load_calibration(folder):
+    '''Description: Load a calibration folder once. The maps are only read afterwards, so
+    clients sharing a folder share a single Calibration.
+    '''
+    calibration = Calibration((IMAGE_WIDTH, IMAGE_HEIGHT))
+    calibration.load_calibration_files(folder)
+    return calibration
 
+def disparity_profile():
+    '''Description: Lambda, sigma, disparity range and matcher parameters of DISPARITY_PROFILE.
+    '''
+    return load_profile(DISPARITY_PROFILE) if DISPARITY_PROFILE else dict(DEFAULT_PROFILE)
 
+def get_disparity_backend(roi = None):
+    '''Description: Worker processes computing disparity, started on first use and shared by
+    every client. They are stopped when the server exits.
+    '''
+    global DISPARITY_BACKEND
+    if DISPARITY_BACKEND is None:
+        from process_disparity import ProcessDisparity
+        DISPARITY_BACKEND = ProcessDisparity(shape = (IMAGE_HEIGHT, IMAGE_WIDTH),
+                                             processes = DISPARITY_PROCESSES,
+                                             strips = DISPARITY_STRIPS, scale = DISPARITY_SCALE,
+                                             roi = roi, **disparity_profile())
+        atexit.register(DISPARITY_BACKEND.close)
+    return DISPARITY_BACKEND
+
+def check_settings():
+    '''Description: Reject combinations of the module constants which are not supported,
+    rather than silently ignoring one of them.
+    Raises: ValueError naming the conflicting settings.
+    '''
+    conflicts = []
+    if ADAPTIVE_QUALITY:
+        for name in ('TEMPORAL_MODE', 'DISPARITY_PROCESSES', 'PIPELINE_MODE', 'ASYNC_MODE'):
+            if globals()[name]:
+                conflicts.append('ADAPTIVE_QUALITY with ' + name)
+    if TEMPORAL_MODE and DISPARITY_VALID_ROWS_ONLY:
+        conflicts.append('TEMPORAL_MODE with DISPARITY_VALID_ROWS_ONLY')
+    if conflicts:
+        raise ValueError('Unsupported settings: {}'.format(', '.join(conflicts)))
+
+def create_disparity_handler(calibration, concurrent = DISPARITY_CONCURRENT):
+    '''Description: Create the disparity handler configured by the module constants.
+    Raises: ValueError if they are not supported together, see check_settings.
+    '''
+    check_settings()
+    roi = calibration.valid_rows() if DISPARITY_VALID_ROWS_ONLY else None
+    if ADAPTIVE_QUALITY:
+        settings = dict(disparity_profile(), concurrent = concurrent, strips = DISPARITY_STRIPS,
+                        scale = DISPARITY_SCALE, roi = roi)
+        return AdaptiveDisparity(lambda level: DisparityCreator(**dict(settings, **level)),
+                                 FRAME_DEADLINE)
+    if DISPARITY_PROCESSES:
+        disparity_handler = get_disparity_backend(roi)
+    else:
+        disparity_handler = DisparityCreator(concurrent = concurrent, strips = DISPARITY_STRIPS,
+                                             scale = DISPARITY_SCALE, roi = roi,
+                                             **disparity_profile())
+    if TEMPORAL_MODE:
+        disparity_handler = TemporalDisparity(disparity_handler, TEMPORAL_THRESHOLD,
+                                              smoothing = TEMPORAL_SMOOTHING)
+    return disparity_handler
+
+class ClientSession(object):
+    '''The processing state of a single client of the multi client server.
+    Methods:
+    close
+    '''
+    def __init__(self, address):
+        '''
+        Parameters:
+        address: (host, port) of the client, selecting its calibration folder.
+        '''
+        host = address[0] if address else None
+        folder = CLIENT_CALIBRATION_FOLDERS.get(host, CALIBRATION_FOLDER)
+        self.calibration = load_calibration(folder)
+        # The shared worker pool already runs clients in parallel
+        self.disparity_handler = create_disparity_handler(self.calibration, concurrent = False)
+        self.segmentation = create_segmentation(self.calibration)
+        print('Client {} connected...'.format(address))
+
+    def __call__(self, left_img, right_img, timer = None):
+        return process_frame(self.calibration, self.disparity_handler, self.segmentation,
+                             left_img, right_img, timer = timer)
+
+    def close(self):
+        # The worker processes outlive the client, they are shared by all clients
+        if not DISPARITY_PROCESSES:
+            self.disparity_handler.close()
 
 def main():
-    calibration = Calibration((IMAGE_WIDTH, IMAGE_HEIGHT))
-    calibration.load_calibration_files(CALIBRATION_FOLDER)
-    
-    disparity_handler = DisparityCreator(16000, 7)
-    connection, server_socket = initialise_connection()
+    check_settings()
+    viewer = None if HEADLESS else DebugViewer(VIEWER_FPS).start()
+    metrics = None
+    if METRICS_ENABLED:
+        metrics = FrameMetrics(FRAME_DEADLINE)
+        MetricsServer(metrics, port = METRICS_PORT, log_interval = METRICS_LOG_INTERVAL).start()
+
+    if ASYNC_MODE:
+        # Only imported when needed, to keep the start of the other modes short
+        import asyncio
+        from async_protocol import AsyncServer
+
+    if ASYNC_MODE and MULTI_CLIENT_MODE:
+        server = AsyncServer(None, metrics = metrics, workers = MULTI_CLIENT_WORKERS,
+                             session_factory = ClientSession)
+        asyncio.run(server.serve('0.0.0.0', 8000))
+        return
+
+    calibration = load_calibration(CALIBRATION_FOLDER)
+    disparity_handler = create_disparity_handler(calibration)
+    segmentation = create_segmentation(calibration)
+
+    if ASYNC_MODE:
+        server = AsyncServer(partial(process_frame, calibration, disparity_handler,
+                                     segmentation, viewer = viewer), metrics = metrics)
+        asyncio.run(server.serve('0.0.0.0', 8000))
+        return
 
-    while True:
-        left_img, right_img = recieve(connection)
-        left_img, right_img = preprocess(calibration, left_img, right_img)
-        
-        data = [left_img, right_img]
-        for line in range(0, int(data[0].shape[0] / 20)):
-            data[0][line * 20, :] = 255
-            data[1][line * 20, :] = 255
-
-
-        cv2.imshow('frames', np.hstack(data))
-
-        disparity = disparity_handler.get_disparity(left_img, right_img)
-        cv2.imshow('disparity', cv2.applyColorMap(disparity, cv2.COLORMAP_JET))
-        nearest, middle = apply_thresholds(disparity)
-        
-        signal = apply_segmentation(nearest, middle)
-        send(connection, pickle.dumps(signal))
-        cv2.waitKey(10)
+    connection, server_socket = initialise_connection()
+    encoding = accept_encoding(connection)
+    recorder = SessionRecorder(RECORD_SESSION) if RECORD_SESSION else None
+    try:
+        if PIPELINE_MODE:
+            run_pipeline(calibration, disparity_handler, segmentation, connection, encoding,
+                         viewer, metrics, recorder)
+        else:
+            serve(calibration, disparity_handler, segmentation, connection, encoding,
+                  viewer, metrics, recorder)
+    finally:
+        if recorder is not None:
+            recorder.close()
 
 
 
@@ -1,22 +1,48 @@
 import os
+import json
+import mmap
+import struct
+import zlib
+import tempfile
 import numpy as np
 import cv2
 
+#: Name of the single file bundle written into the calibration folder
+BUNDLE = 'calibration.bundle'
+BUNDLE_MAGIC = b'DRCB'
+BUNDLE_VERSION = 1
+#: magic, version, length of the JSON description
+BUNDLE_HEADER = struct.Struct('<4sBI')
+#: Arrays are aligned to this many bytes in the bundle
+BUNDLE_ALIGNMENT = 64
+
 class Calibration(object):
     '''
     A class to load all calibration files
     Methods defined:
     @public: load_calibration_files(folder_name)
+             load_bundle(filename)
+             save_bundle(filename)
+             save_calibration_files(folder_name)
+             valid_rows()
+             load_identity()
+             remap(side, img)
     @private: _modify_undistort_and_rectify_maps()
+              _compute_fixed_maps()
+              _arrays()
     '''
-    def __init__(self, size):
+    #: Attributes which are computed rather than loaded from the calibration folder
+    DERIVED = ('size', 'undistortion_map', 'rectification_map', 'fixed_maps', 'keep_float_maps')
+
+    def __init__(self, size, keep_float_maps = False):
         '''
         Initialise all calibration parameters
         Parameters initialised:
         cam_mats, dist_coefs, rot_mat, trans_vec, e_mat, f_mat, rect_trans,
         proj_mats, disp_to_depth_mat, valid_boxes, undistortion_map,
-        rectification_map
+        rectification_map, fixed_maps
         @params: size - Size of the image.
+                 keep_float_maps - Keep the CV_32FC1 maps once the fixed point maps exist.
         '''
         self.cam_mats = {"left": None, "right": None}
         #: Distortion coefficients (D)
@@ -41,17 +67,33 @@ class Calibration(object):
         self.undistortion_map = {"left": None, "right": None}
         #: Rectification maps for remapping
         self.rectification_map = {"left": None, "right": None}
+        #: Compact fixed point maps (CV_16SC2 coordinates, CV_16UC1 interpolation weights)
+        self.fixed_maps = {"left": None, "right": None}
         #: Size of the image
         self.size = size
+        self.keep_float_maps = keep_float_maps
 
     def load_calibration_files(self, folder):
         '''
         Description: Load all calibration files and also modify undistortion_maps and
-        rectification_maps
+        rectification_maps. Everything, including the fixed point maps, is cached in a single
+        bundle in the calibration folder, so that later starts memory-map one file instead
+        of loading every matrix and computing the maps.
         Parameters: folder: name of the calibration folder
         '''
+        bundle = os.path.join(folder, BUNDLE)
+        sources = [os.path.join(folder, file) for file in os.listdir(folder)
+                   if file.endswith('.npy')]
+        if (not self.keep_float_maps and os.path.exists(bundle) and
+                all(os.path.getmtime(file) <= os.path.getmtime(bundle) for file in sources)):
+            try:
+                self.load_bundle(bundle)
+                return
+            except ValueError:
+                pass
+
         for key, item in self.__dict__.items():
-            if key == 'size':
+            if key in self.DERIVED:
                 continue
             if isinstance(item, dict):
                 for side in ("left", "right"):
@@ -62,8 +104,185 @@ class Calibration(object):
                 filename = os.path.join(folder, "{}.npy".format(key))
                 self.__dict__[key] = np.load(filename)
 
+        self._compute_fixed_maps()
+        try:
+            self.save_bundle(bundle)
+        except OSError:
+            # Read-only calibration folder
+            pass
+
+    def save_calibration_files(self, folder):
+        '''
+        Description: Save every calibration matrix in the layout read by
+        load_calibration_files, one .npy file per matrix and side.
+        Parameters: folder: name of the calibration folder, created if needed
+        '''
+        os.makedirs(folder, exist_ok = True)
+        for key, item in self.__dict__.items():
+            if key in self.DERIVED:
+                continue
+            if isinstance(item, dict):
+                for side in ("left", "right"):
+                    np.save(os.path.join(folder, "{}_{}.npy".format(key, side)), item[side])
+            else:
+                np.save(os.path.join(folder, "{}.npy".format(key)), item)
+
+    def _arrays(self):
+        '''
+        Description: Every array held in a bundle, by name.
+        '''
+        arrays = {}
+        for key, item in self.__dict__.items():
+            if key in self.DERIVED:
+                continue
+            if isinstance(item, dict):
+                for side in ("left", "right"):
+                    arrays["{}/{}".format(key, side)] = item[side]
+            else:
+                arrays[key] = item
+        for side in ("left", "right"):
+            for index, fixed_map in enumerate(self.fixed_maps[side]):
+                arrays["fixed_maps/{}/{}".format(side, index)] = fixed_map
+        return arrays
+
+    def save_bundle(self, filename):
+        '''
+        Description: Write all matrices and the fixed point maps into a single versioned file.
+        A JSON description holds the image size, the dtype, shape and offset of every array,
+        and a CRC32 checksum of the array data.
+        Parameters: filename: Bundle file name
+        '''
+        arrays = {name: np.ascontiguousarray(array) for name, array in self._arrays().items()}
+        description = {'size': list(self.size), 'arrays': {}}
+        offset = 0
+        for name, array in arrays.items():
+            description['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape,
+                                           'offset': offset}
+            offset += -(-array.nbytes // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+        data = bytearray(offset)
+        for name, array in arrays.items():
+            start = description['arrays'][name]['offset']
+            data[start:start + array.nbytes] = array.tobytes()
+        description['checksum'] = zlib.crc32(data)
+
+        header = json.dumps(description).encode()
+        # Pad the description so that the array data starts aligned
+        padding = -(BUNDLE_HEADER.size + len(header)) % BUNDLE_ALIGNMENT
+        header += b' ' * padding
+        # A unique temporary file next to the bundle, so that concurrent writers cannot clash
+        # and the final rename stays on the same filesystem
+        descriptor, temporary = tempfile.mkstemp(dir = os.path.dirname(filename) or '.',
+                                                 prefix = os.path.basename(filename) + '.',
+                                                 suffix = '.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(header)))
+                file.write(header)
+                file.write(data)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, filename)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+    def load_bundle(self, filename, verify = True):
+        '''
+        Description: Load a bundle written by save_bundle. Arrays are read only views
+        into the memory-mapped file.
+        Parameters: filename: Bundle file name
+                    verify: Check the checksum of the array data.
+        Raises: ValueError if the bundle has another version or image size, or is corrupt.
+        '''
+        with open(filename, 'rb') as file:
+            data = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(data) < BUNDLE_HEADER.size:
+            raise ValueError('{} is not a calibration bundle'.format(filename))
+        magic, version, length = BUNDLE_HEADER.unpack_from(data, 0)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise ValueError('{} is not a version {} calibration bundle'.format(
+                             filename, BUNDLE_VERSION))
+        description = json.loads(bytes(data[BUNDLE_HEADER.size:BUNDLE_HEADER.size + length]))
+        if tuple(description['size']) != tuple(self.size):
+            raise ValueError('{} was made for images of size {}, not {}'.format(
+                             filename, tuple(description['size']), tuple(self.size)))
+        start = BUNDLE_HEADER.size + length
+        if verify and zlib.crc32(memoryview(data)[start:]) != description['checksum']:
+            raise ValueError('{} is corrupt'.format(filename))
+
+        fixed_maps = {"left": [None, None], "right": [None, None]}
+        for name, array in description['arrays'].items():
+            value = np.frombuffer(data, dtype = np.dtype(array['dtype']),
+                                  count = int(np.prod(array['shape'])),
+                                  offset = start + array['offset']).reshape(array['shape'])
+            key, *rest = name.split('/')
+            if key == 'fixed_maps':
+                fixed_maps[rest[0]][int(rest[1])] = value
+            elif rest:
+                self.__dict__[key][rest[0]] = value
+            else:
+                self.__dict__[key] = value
+        self.fixed_maps = {side: tuple(maps) for side, maps in fixed_maps.items()}
+
+    def load_identity(self, focal_length = 500.0, baseline = 0.06):
+        '''
+        Description: Set up a synthetic, already rectified camera pair whose maps leave
+        images unchanged. Useful to run the pipeline on synthetic or pre-rectified images.
+        Parameters: focal_length - Focal length in pixels.
+                    baseline - Distance between the cameras in metres.
+        '''
+        width, height = self.size
+        cam_mat = np.array([[focal_length, 0, width / 2],
+                            [0, focal_length, height / 2],
+                            [0, 0, 1]])
+        for side, offset in (("left", 0.0), ("right", -baseline * focal_length)):
+            self.cam_mats[side] = cam_mat
+            self.dist_coefs[side] = np.zeros(5)
+            self.rect_trans[side] = np.eye(3)
+            self.proj_mats[side] = np.hstack([cam_mat, [[offset], [0], [0]]])
+            self.valid_boxes[side] = np.array([0, 0, width, height])
+        self.rot_mat = np.eye(3)
+        self.trans_vec = np.array([[-baseline], [0], [0]])
+        self.e_mat = np.array([[0, 0, 0], [0, 0, baseline], [0, -baseline, 0]])
+        self.f_mat = np.linalg.inv(cam_mat).T @ self.e_mat @ np.linalg.inv(cam_mat)
+        self.disp_to_depth_mat = np.array([[1, 0, 0, -width / 2],
+                                           [0, 1, 0, -height / 2],
+                                           [0, 0, 0, focal_length],
+                                           [0, 0, 1 / baseline, 0]])
+        self._compute_fixed_maps()
+
+    def _compute_fixed_maps(self):
+        '''
+        Description: Compute the float maps and convert them to fixed point maps.
+        '''
         self._modify_undistort_and_rectify_maps()
+        for side in ("left", "right"):
+            self.fixed_maps[side] = cv2.convertMaps(self.undistortion_map[side],
+                                                    self.rectification_map[side],
+                                                    cv2.CV_16SC2)
+        if not self.keep_float_maps:
+            self.undistortion_map = {"left": None, "right": None}
+            self.rectification_map = {"left": None, "right": None}
+
+    def remap(self, side, img):
+        '''
+        Description: Undistort and rectify an image, using the fixed point maps.
+        Parameters: side - "left" or "right"
+                    img - Image taken by the camera on that side.
+        '''
+        map1, map2 = self.fixed_maps[side]
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
 
+    def valid_rows(self):
+        '''
+        Description: Band of rows which hold valid pixels in both rectified images.
+        Returns: (top, bottom) row range, usable as DisparityCreator roi.
+        '''
+        boxes = [np.ravel(self.valid_boxes[side]).astype(int) for side in ("left", "right")]
+        top = max(box[1] for box in boxes)
+        bottom = min(box[1] + box[3] for box in boxes)
+        return int(top), int(bottom)
 
     def _modify_undistort_and_rectify_maps(self):
         '''Description: Modification necessary to obtain proper disparity
@@ -0,0 +1,220 @@
+'''
+Description: Low overhead per frame latency instrumentation for the server.
+            Every frame carries a FrameTimer which records a monotonic timestamp as it
+            leaves each stage. Finished frames feed rolling latency windows per stage, along
+            with counters of dropped and late frames. The metrics are served as plain text
+            over a local HTTP endpoint and summarised in a periodic log line.
+'''
+
+
+import time
+from threading import Thread, Lock
+
+import numpy as np
+
+
+class FrameTimer(object):
+    '''Monotonic timestamps of a single frame, taken as it leaves each stage. Waits in queues
+    are marked as 'queued' when the frame leaves a queue, possibly several times per frame.
+    '''
+    def __init__(self, frame_id, capture_time = None):
+        '''
+        Parameters:
+        frame_id: Sequence number stamped by the client at capture time.
+        capture_time: time.time() of the capture on the client, if known.
+        '''
+        self.frame_id = frame_id
+        self.capture_time = capture_time
+        self.marks = [('start', time.perf_counter())]
+
+    def mark(self, stage):
+        '''Description: Record that the frame has just finished the given stage.
+        '''
+        self.marks.append((stage, time.perf_counter()))
+
+
+class RollingHistogram(object):
+    '''A fixed size ring of the most recent samples. Recording a sample is a single store,
+    percentiles and bucket counts are only computed when reported.
+    '''
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, float('inf'))
+
+    def __init__(self, size = 1024):
+        self.samples = np.zeros(size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def report(self):
+        '''Description: Summarise the window, in milliseconds.
+        '''
+        window = self.samples[:min(self.count, len(self.samples))] * 1000
+        if not len(window):
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(window, (50, 95, 99))
+        counts = np.bincount(np.searchsorted(self.BUCKETS_MS, window),
+                             minlength = len(self.BUCKETS_MS))
+        return {'count': self.count, 'p50': p50, 'p95': p95, 'p99': p99, 'max': window.max(),
+                'buckets': dict(zip(self.BUCKETS_MS, counts.tolist()))}
+
+
+class FrameMetrics(object):
+    '''A class to collect per stage latencies and frame counters.
+    Methods:
+    start_frame
+    finish
+    drop
+    report
+    summary_line
+    '''
+    def __init__(self, deadline = 0.2, window = 1024):
+        '''
+        Parameters:
+        deadline: Seconds after which a processed frame counts as late.
+        window: Number of recent frames kept per histogram.
+        '''
+        self.deadline = deadline
+        self.window = window
+        self.histograms = {}
+        self.frames = 0
+        self.dropped = 0
+        self.late = 0
+        self.lock = Lock()
+        self.start_time = time.monotonic()
+
+    def start_frame(self, frame_id, capture_time = None):
+        '''Description: Create the timer of a new frame.
+        '''
+        return FrameTimer(frame_id, capture_time)
+
+    def _histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = RollingHistogram(self.window)
+        return histogram
+
+    def finish(self, timer):
+        '''Description: Record the stage latencies of a frame which has been answered.
+        '''
+        now = time.time()
+        with self.lock:
+            self.frames += 1
+            # A stage marked several times, e.g. every queue wait, counts once in total
+            durations = {}
+            for (_, previous), (stage, current) in zip(timer.marks, timer.marks[1:]):
+                durations[stage] = durations.get(stage, 0.0) + current - previous
+            for stage, duration in durations.items():
+                self._histogram(stage).add(duration)
+            total = timer.marks[-1][1] - timer.marks[0][1]
+            self._histogram('server_total').add(total)
+            if timer.capture_time is not None:
+                # Relies on the client and server clocks being synchronised, e.g. by NTP
+                self._histogram('capture_to_signal').add(now - timer.capture_time)
+            if total > self.deadline:
+                self.late += 1
+
+    def drop(self, timer = None):
+        '''Description: Count a frame which was dropped without being processed.
+        '''
+        with self.lock:
+            self.dropped += 1
+
+    def report(self):
+        '''Description: Snapshot of all counters and histograms.
+        '''
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            return {'frames': self.frames,
+                    'dropped': self.dropped,
+                    'late': self.late,
+                    'fps': self.frames / elapsed,
+                    'stages': {name: histogram.report()
+                               for name, histogram in self.histograms.items()}}
+
+    def summary_line(self):
+        '''Description: A one line summary of throughput and p50/p95 stage latencies.
+        '''
+        report = self.report()
+        stages = ', '.join('{} {:.1f}/{:.1f}'.format(name, stage['p50'], stage['p95'])
+                           for name, stage in report['stages'].items() if stage['count'])
+        return ('{frames} frames, {fps:.1f} fps, {dropped} dropped, {late} late | '
+                'p50/p95 ms: ').format(**report) + stages
+
+    def to_text(self):
+        '''Description: Metrics in a plain text, one value per line format.
+        '''
+        report = self.report()
+        lines = ['dristi_frames_total {}'.format(report['frames']),
+                 'dristi_frames_dropped_total {}'.format(report['dropped']),
+                 'dristi_frames_late_total {}'.format(report['late']),
+                 'dristi_fps {:.3f}'.format(report['fps'])]
+        for name, stage in sorted(report['stages'].items()):
+            if not stage['count']:
+                continue
+            for key in ('p50', 'p95', 'p99', 'max'):
+                lines.append('dristi_latency_ms{{stage="{}",quantile="{}"}} {:.3f}'.format(
+                             name, key, stage[key]))
+            for bucket, count in stage['buckets'].items():
+                lines.append('dristi_latency_bucket{{stage="{}",le="{}"}} {}'.format(
+                             name, bucket, count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(object):
+    '''A class to serve FrameMetrics as plain text over HTTP, and print a periodic log line.
+    Methods:
+    start
+    stop
+    '''
+    def __init__(self, metrics, host = '127.0.0.1', port = 8001, log_interval = 30):
+        '''
+        Parameters:
+        metrics: FrameMetrics instance.
+        host, port: Address to serve on, localhost by default.
+        log_interval: Seconds between two log lines, None disables logging.
+        '''
+        self.metrics = metrics
+        self.address = (host, port)
+        self.log_interval = log_interval
+        self.stopped = False
+
+    def start(self):
+        '''Description: Start the HTTP server and the logging thread.
+        '''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(self.address, Handler)
+        self.server.daemon_threads = True
+        self.http_thread = Thread(target = self.server.serve_forever)
+        self.http_thread.daemon = True
+        self.http_thread.start()
+
+        if self.log_interval:
+            self.log_thread = Thread(target = self._log)
+            self.log_thread.daemon = True
+            self.log_thread.start()
+        return self
+
+    def _log(self):
+        while not self.stopped:
+            time.sleep(self.log_interval)
+            print('Metrics: {}'.format(self.metrics.summary_line()))
+
+    def stop(self):
+        self.stopped = True
+        self.server.shutdown()
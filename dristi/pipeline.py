@@ -0,0 +1,283 @@
+'''
+Description: Building blocks to run the server processing as a staged pipeline.
+            Each stage runs on its own thread and stages are joined by bounded queues,
+            so that network waits and disparity computation can overlap.
+'''
+
+
+import time
+from collections import deque
+from threading import Thread, Lock, Condition
+
+
+class Frame(object):
+    '''A container for everything that is known about a single stereo frame
+    as it moves through the pipeline.
+    '''
+    def __init__(self, frame_id, left_img = None, right_img = None):
+        '''
+        Parameters:
+        frame_id: Sequence number of the frame.
+        left_img: Left image.
+        right_img: Right image.
+        '''
+        self.frame_id = frame_id
+        self.timestamp = time.monotonic()
+        self.left_img = left_img
+        self.right_img = right_img
+        self.disparity = None
+        self.nearest = None
+        self.middle = None
+        self.signal = None
+        self.dropped = False
+        self.timer = None
+        self.buffer = None
+
+    def age(self):
+        '''Description: Seconds elapsed since the frame entered the pipeline.
+        '''
+        return time.monotonic() - self.timestamp
+
+
+class FrameQueue(object):
+    '''A bounded queue which never blocks the producer. When it is full, the
+    oldest item is discarded to make room, so that consumers always work on
+    the most recent frames.
+    Methods:
+    put
+    get
+    close
+    '''
+    def __init__(self, maxsize, on_drop = None):
+        '''
+        Parameters:
+        maxsize: Maximum number of items held by the queue.
+        on_drop: Callable invoked with every item discarded from the queue.
+        '''
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.items = deque()
+        self.closed = False
+        self.condition = Condition(Lock())
+
+    def put(self, item):
+        '''Description: Add an item, discarding the oldest one if the queue is full.
+        '''
+        dropped = None
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+            self.items.append(item)
+            self.condition.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self, timeout = None):
+        '''Description: Remove and return the oldest item.
+        Returns None if the queue is closed and empty, or on timeout.
+        '''
+        with self.condition:
+            if not self.items and not self.closed:
+                self.condition.wait(timeout)
+            if self.items:
+                return self.items.popleft()
+            return None
+
+    def close(self):
+        '''Description: Wake up all consumers, signalling that no more items will come.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StageStats(object):
+    '''Throughput counters for a single stage.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.busy_time = 0.0
+        self.start_time = time.monotonic()
+        self.lock = Lock()
+
+    def add(self, elapsed):
+        with self.lock:
+            self.processed += 1
+            self.busy_time += elapsed
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def report(self):
+        '''Description: Summarise the counters.
+        Returns:
+        A dict with processed/dropped frames, frames per second, mean time per frame
+        in milliseconds and the fraction of wall time the stage was busy.
+        '''
+        with self.lock:
+            wall = max(time.monotonic() - self.start_time, 1e-9)
+            mean = self.busy_time / self.processed if self.processed else 0.0
+            return {'stage': self.name,
+                    'processed': self.processed,
+                    'dropped': self.dropped,
+                    'fps': self.processed / wall,
+                    'mean_ms': mean * 1000,
+                    'utilisation': self.busy_time / wall}
+
+
+class Stage(Thread):
+    '''A pipeline stage running on its own thread.
+    A stage without an input queue is a source, its function is called repeatedly
+    without arguments and returns new frames. A stage without an output queue is a sink.
+    Stale frames, older than max_age seconds, are not processed but handed to on_drop.
+    '''
+    def __init__(self, name, func, input_queue = None, output_queue = None,
+                 max_age = None, on_drop = None):
+        '''
+        Parameters:
+        name: Name of the stage, used in reports.
+        func: Callable processing a frame (or producing one, for sources).
+        input_queue: FrameQueue to read frames from.
+        output_queue: FrameQueue to write processed frames to.
+        max_age: Frames older than this many seconds are dropped.
+        on_drop: Callable invoked with every frame dropped by this stage.
+        '''
+        Thread.__init__(self, name = name)
+        self.daemon = True
+        self.func = func
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.max_age = max_age
+        self.on_drop = on_drop
+        self.stats = StageStats(name)
+        self.stopped = False
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stopped:
+                if self.input_queue is None:
+                    frame = None
+                else:
+                    frame = self.input_queue.get(timeout = 0.1)
+                    if frame is None:
+                        if self.input_queue.closed:
+                            break
+                        continue
+                    if self.max_age is not None and frame.age() > self.max_age:
+                        self.drop(frame)
+                        continue
+                    # Time spent waiting in the queue is not part of this stage's work
+                    if frame.timer is not None:
+                        frame.timer.mark('queued')
+
+                start = time.monotonic()
+                frame = self.func() if self.input_queue is None else self.func(frame)
+                self.stats.add(time.monotonic() - start)
+
+                if frame is None:
+                    break
+                if self.output_queue is not None:
+                    self.output_queue.put(frame)
+        except Exception as error:
+            self.error = error
+        finally:
+            self.stopped = True
+            if self.output_queue is not None:
+                self.output_queue.close()
+
+    def drop(self, frame):
+        '''Description: Record a dropped frame and pass it on to the drop handler.
+        '''
+        self.stats.drop()
+        frame.dropped = True
+        if self.on_drop is not None:
+            self.on_drop(frame)
+
+    def stop(self):
+        self.stopped = True
+
+
+class Pipeline(object):
+    '''A linear chain of stages joined by bounded, stale-dropping queues.
+    Methods:
+    add_stage
+    start
+    stop
+    join
+    report
+    '''
+    def __init__(self, queue_size = 2, max_age = None, on_drop = None):
+        '''
+        Parameters:
+        queue_size: Capacity of the queue between consecutive stages.
+        max_age: Frames older than this many seconds are dropped before processing.
+        on_drop: Callable invoked with every dropped frame, e.g. to still answer the client.
+        '''
+        self.queue_size = queue_size
+        self.max_age = max_age
+        self.on_drop = on_drop
+        self.stages = []
+        self.queues = []
+
+    def add_stage(self, name, func):
+        '''Description: Append a stage. The first stage added is the source.
+        '''
+        if self.stages:
+            stage = Stage(name, func, max_age = self.max_age, on_drop = self.on_drop)
+            stage.input_queue = FrameQueue(self.queue_size, on_drop = stage.drop)
+            self.stages[-1].output_queue = stage.input_queue
+            self.queues.append(stage.input_queue)
+        else:
+            stage = Stage(name, func)
+        self.stages.append(stage)
+        return stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        for queue in self.queues:
+            queue.close()
+
+    def join(self, report_interval = None):
+        '''Description: Wait for the pipeline to finish, printing a throughput report
+        every report_interval seconds.
+        '''
+        last_report = time.monotonic()
+        while any(stage.is_alive() for stage in self.stages):
+            self.stages[-1].join(timeout = 0.5)
+            if report_interval and time.monotonic() - last_report > report_interval:
+                self.print_report()
+                last_report = time.monotonic()
+            for stage in self.stages:
+                if stage.error is not None:
+                    self.stop()
+                    raise stage.error
+
+    def report(self):
+        '''Description: Per-stage throughput report, along with queue occupancy.
+        '''
+        reports = [stage.stats.report() for stage in self.stages]
+        for report, stage in zip(reports, self.stages):
+            report['queued'] = len(stage.input_queue) if stage.input_queue is not None else 0
+        return reports
+
+    def print_report(self):
+        reports = self.report()
+        # The source's time includes waiting for its input, e.g. a blocking recv for the
+        # next frame, so a busy source is mostly idle and not a bottleneck
+        bottleneck = max(reports[1:] or reports, key = lambda report: report['utilisation'])
+        for report in reports:
+            print('{stage:>10}: {fps:6.1f} fps, {mean_ms:7.2f} ms/frame, '
+                  '{utilisation:5.0%} busy, {dropped} dropped, {queued} queued'.format(**report))
+        print('Bottleneck: {}'.format(bottleneck['stage']))
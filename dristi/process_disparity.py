@@ -0,0 +1,174 @@
+'''
+Description: Disparity computed by DisparityCreator instances running in worker processes,
+            so that matching and all of its Python-side post-processing run on every core
+            without contending for the GIL. Frames and disparity maps are passed through a
+            ring of slots in shared memory; only slot indices go through the queues.
+'''
+
+
+import threading
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+def _worker(name, ring_shape, Lambda, sigma, kwargs, tasks, results):
+    '''Description: Worker process loop, computing the disparity of the frame in a slot.
+    '''
+    from disparity import DisparityCreator
+
+    memory = SharedMemory(name = name)
+    ring = np.ndarray(ring_shape, dtype = np.uint8, buffer = memory.buf)
+    frame = None
+    disparity_handler = DisparityCreator(Lambda, sigma, **kwargs)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            ticket, slot, height, width = task
+            frame = ring[slot, :, :height, :width]
+            frame[2] = disparity_handler.get_disparity(frame[0], frame[1])
+            results.put((ticket, slot))
+    finally:
+        disparity_handler.close()
+        # Views into the shared memory must be gone before it can be closed
+        ring = frame = None
+        memory.close()
+
+
+class ProcessDisparity(object):
+    '''
+    A class to compute disparity maps on a pool of worker processes.
+    Every slot of the shared memory ring holds a left image, a right image and the disparity
+    computed from them. Submitting a frame copies it into a free slot, and blocks while all
+    slots are in use. Any number of threads can submit frames at the same time.
+    Parameters:
+    Lambda: Lambda parameter for WLS filter
+    sigma: SigmaColor value for WLS filter
+    shape: (height, width) of the largest image, smaller images such as strips also fit.
+    processes: Number of worker processes.
+    slots: Number of frames in flight, defaults to twice the number of processes.
+    kwargs: Further DisparityCreator parameters. The output must have the input size,
+            so upsample must not be disabled.
+    Methods:
+    submit
+    result
+    get_disparity
+    map
+    close
+    '''
+    def __init__(self, Lambda, sigma, shape, processes = 2, slots = None, **kwargs):
+        if kwargs.get('raw'):
+            raise ValueError('Slots hold uint8 disparity maps, raw disparity is not supported')
+        self.shape = tuple(shape)
+        self.slots = slots or 2 * processes
+        ring_shape = (self.slots, 3) + self.shape
+        self.memory = SharedMemory(create = True, size = int(np.prod(ring_shape)))
+        self.ring = np.ndarray(ring_shape, dtype = np.uint8, buffer = self.memory.buf)
+
+        context = get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [context.Process(target = _worker, daemon = True,
+                                          args = (self.memory.name, ring_shape, Lambda, sigma,
+                                                  kwargs, self.tasks, self.results))
+                          for _ in range(processes)]
+        for process in self.processes:
+            process.start()
+
+        self.condition = threading.Condition()
+        self.free = list(range(self.slots))
+        self.shapes = {}
+        self.done = {}
+        self.next_ticket = 0
+        self.closed = False
+        self.collector = threading.Thread(target = self._collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def _collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            with self.condition:
+                ticket, slot = result
+                self.done[ticket] = slot
+                self.condition.notify_all()
+
+    def submit(self, left_img, right_img):
+        '''Description: Queue a pair of rectified grayscale images.
+        Return:
+        ticket: Number to pass to result, increasing in submission order.
+        '''
+        height, width = left_img.shape[:2]
+        if height > self.shape[0] or width > self.shape[1]:
+            raise ValueError('Images of shape {} do not fit slots of shape {}'.format(
+                             left_img.shape, self.shape))
+        with self.condition:
+            self.condition.wait_for(lambda: self.free)
+            slot = self.free.pop()
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.shapes[ticket] = (height, width)
+        self.ring[slot, 0, :height, :width] = left_img
+        self.ring[slot, 1, :height, :width] = right_img
+        self.tasks.put((ticket, slot, height, width))
+        return ticket
+
+    def result(self, ticket):
+        '''Description: Wait for the disparity of a submitted frame.
+        Parameters:
+        ticket: Value returned by submit.
+        Return:
+        disparity: Disparity map, copied out of its slot so the slot can be reused.
+        '''
+        with self.condition:
+            while not self.condition.wait_for(lambda: ticket in self.done, timeout = 1.0):
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError('A disparity worker process has died')
+            slot = self.done.pop(ticket)
+            height, width = self.shapes.pop(ticket)
+        disparity = self.ring[slot, 2, :height, :width].copy()
+        with self.condition:
+            self.free.append(slot)
+            self.condition.notify_all()
+        return disparity
+
+    def get_disparity(self, left_img, right_img):
+        '''Get disparity map for corresponding left and right images.
+        Parameters:
+        left_img: Left image
+        right_img: Right image
+        '''
+        return self.result(self.submit(left_img, right_img))
+
+    def map(self, pairs):
+        '''Description: Compute the disparity of a sequence of image pairs, keeping every
+        slot busy, and yield the disparities in frame order.
+        '''
+        tickets = []
+        for left_img, right_img in pairs:
+            if len(tickets) == self.slots:
+                yield self.result(tickets.pop(0))
+            tickets.append(self.submit(left_img, right_img))
+        for ticket in tickets:
+            yield self.result(ticket)
+
+    def close(self):
+        '''Description: Stop the worker processes and release the shared memory.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+        del self.ring
+        self.memory.close()
+        self.memory.unlink()
@@ -0,0 +1,143 @@
+'''
+Description: Cheaper disparity processing modes, and a tool to measure their latency and how
+            often their zone decisions agree with full resolution processing.
+            Usage: python processing_modes.py <images_folder> [calibration_folder] [frames]
+'''
+
+
+import sys, time
+
+from disparity import DisparityCreator
+from segmentation import SegmentationEngine
+
+
+class CoarseToFine(object):
+    '''
+    A class to compute disparity at low resolution first, and refine at full resolution only
+    the column zones which are flagged as occupied by the low resolution map.
+    Methods:
+    get_disparity
+    '''
+    def __init__(self, Lambda, sigma, segmentation, scale = 0.25, margin = 8, **kwargs):
+        '''
+        Parameters:
+        Lambda: Lambda parameter for WLS filter
+        sigma: SigmaColor value for WLS filter
+        segmentation: SegmentationEngine deciding which zones to refine.
+        scale: Scale of the coarse pass.
+        margin: Extra columns matched on both sides of a refined zone.
+        kwargs: Further DisparityCreator parameters, shared by both passes.
+        '''
+        self.coarse = DisparityCreator(Lambda, sigma, scale = scale, upsample = True, **kwargs)
+        self.fine = DisparityCreator(Lambda, sigma, **kwargs)
+        self.segmentation = segmentation
+        self.margin = margin
+        self.refined_columns = 0
+
+    def get_disparity(self, left_img, right_img):
+        '''Get disparity map for corresponding left and right images.
+        Parameters:
+        left_img: Left image
+        right_img: Right image
+        '''
+        disparity = self.coarse.get_disparity(left_img, right_img)
+        signal = self.segmentation.segment(disparity)
+
+        ranges = []
+        for flags, bounds in ((signal['nearest'], self.segmentation.nearest_bounds),
+                              (signal['middle'], self.segmentation.middle_bounds)):
+            ranges.extend(bound for flag, bound in zip(flags, bounds) if flag)
+        width = left_img.shape[1]
+        for start, end in self._merge(ranges):
+            # A pixel at column x is matched against right image columns down to x - numDisparities
+            first = max(0, start - self.fine.num_disparities - self.margin)
+            last = min(width, end + self.margin)
+            refined = self.fine.get_disparity(left_img[:, first:last], right_img[:, first:last])
+            disparity[:, start:end] = refined[:, start - first:end - first]
+            self.refined_columns += end - start
+        return disparity
+
+    @staticmethod
+    def _merge(ranges):
+        '''Description: Merge overlapping column ranges.
+        '''
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+
+def create_modes(Lambda, sigma, calibration = None):
+    '''Description: Create the available processing modes.
+    Parameters:
+    Lambda: Lambda parameter for WLS filter
+    sigma: SigmaColor value for WLS filter
+    calibration: Calibration, required for the band of interest mode.
+    Return:
+    modes: dict of mode name to an object with a get_disparity method.
+    '''
+    modes = {'full': DisparityCreator(Lambda, sigma),
+             'half': DisparityCreator(Lambda, sigma, scale = 0.5),
+             'quarter': DisparityCreator(Lambda, sigma, scale = 0.25),
+             'coarse_to_fine': CoarseToFine(Lambda, sigma, SegmentationEngine())}
+    if calibration is not None:
+        modes['band_of_interest'] = DisparityCreator(Lambda, sigma, roi = calibration.valid_rows())
+    return modes
+
+
+def compare_modes(modes, pairs, reference = 'full'):
+    '''Description: Measure the latency of every mode, and the fraction of zone decisions
+    which agree with the reference mode.
+    Parameters:
+    modes: dict of mode name to an object with a get_disparity method.
+    pairs: List of rectified grayscale (left, right) image pairs.
+    reference: Name of the reference mode.
+    Return:
+    results: dict of mode name to {'latency_ms', 'agreement'}
+    '''
+    segmentation = SegmentationEngine()
+    signals = {}
+    results = {}
+    for name in [reference] + [name for name in modes if name != reference]:
+        elapsed = 0.0
+        signals[name] = []
+        for left_img, right_img in pairs:
+            start = time.perf_counter()
+            disparity = modes[name].get_disparity(left_img, right_img)
+            elapsed += time.perf_counter() - start
+            signal = segmentation.segment(disparity)
+            signals[name].append(signal['nearest'] + signal['middle'])
+
+        agreeing = sum(flag == reference_flag
+                       for flags, reference_flags in zip(signals[name], signals[reference])
+                       for flag, reference_flag in zip(flags, reference_flags))
+        total = sum(len(flags) for flags in signals[reference])
+        results[name] = {'latency_ms': elapsed / max(len(pairs), 1) * 1000,
+                         'agreement': agreeing / max(total, 1)}
+    return results
+
+
+if __name__ == '__main__':
+    from image_loader import ReadImages
+    from load_calibration import Calibration
+    from laptop_server import IMAGE_WIDTH, IMAGE_HEIGHT, preprocess
+
+    loader = ReadImages(sys.argv[1], grayscale = True)
+    calibration = None
+    if len(sys.argv) > 2:
+        calibration = Calibration((IMAGE_WIDTH, IMAGE_HEIGHT))
+        calibration.load_calibration_files(sys.argv[2])
+    frames = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    pairs = []
+    for _ in range(min(frames, len(loader))):
+        left_img, right_img = loader.load_images()
+        if calibration is not None:
+            left_img, right_img = preprocess(calibration, left_img, right_img)
+        pairs.append((left_img, right_img))
+
+    for name, result in compare_modes(create_modes(16000, 7, calibration), pairs).items():
+        print('{:>16}: {latency_ms:7.1f} ms, {agreement:6.1%} zone agreement'.format(name, **result))
@@ -0,0 +1,317 @@
+'''
+Description: Wire format shared by the Raspberry Pi client and the laptop server.
+            A connection starts with a hello exchange, where the client asks for a frame
+            encoding and the server answers with the one it accepts. Every frame is then
+            preceded by a versioned header carrying its size, encoding, frame id and the
+            wall clock time at which the client captured it. Every signal is a fixed size
+            record of zone flags, with the distance of every zone when the server measures it.
+'''
+
+
+import sys, struct, time, zlib
+
+import numpy as np
+import cv2
+
+
+MAGIC = b'DRST'
+VERSION = 3
+
+ENCODING_RAW = 0
+ENCODING_JPEG = 1
+ENCODING_PNG = 2
+ENCODING_DELTA = 3
+ENCODINGS = {'raw': ENCODING_RAW, 'jpeg': ENCODING_JPEG,
+             'png': ENCODING_PNG, 'delta': ENCODING_DELTA}
+
+# magic, version, encoding
+HELLO = struct.Struct('<4sBB')
+# magic, version, encoding, width, height, frame id, payload length, capture time
+HEADER = struct.Struct('<4sBBHHIId')
+# frame id, bitmask of occupied nearest zones, bitmask of occupied middle zones, distance in
+# centimetres of the closest obstacle in each of the 3 nearest then 4 middle zones
+SIGNAL = struct.Struct('<IBB7H')
+DISTANCE_SLOTS = 7
+# Bit of the middle zones mask set on a reply which repeats the last signal, e.g. for a
+# dropped frame, instead of being computed from the frame it answers
+FALLBACK = 0x80
+# Bit of the middle zones mask set when the record carries zone distances
+DISTANCES = 0x40
+# Distance of a free or unmeasured zone
+NO_DISTANCE = 0xFFFF
+
+
+def recv_exactly(connection, view):
+    '''
+    Description: Receive exactly len(view) bytes straight into view, handling short reads.
+    Parameters:
+    connection: Connection object.
+    view: Writable memoryview to fill.
+    '''
+    received = 0
+    length = len(view)
+    while received < length:
+        count = connection.recv_into(view[received:])
+        if not count:
+            sys.exit()
+        received += count
+
+
+def pack_signal(frame_id, signal, fallback = False):
+    '''Description: Encode a control signal in a fixed size binary record.
+    Parameters:
+    frame_id: Sequence number of the frame the signal was computed from, or answered by.
+    signal: Control signal, {'nearest': [...], 'middle': [...]} of 0/1 zone flags, with
+            {'nearest': [...], 'middle': [...]} zone distances in metres in 'distances' if
+            they were measured, inf for a free zone.
+    fallback: The signal is the last known one, not computed from this frame.
+    Return:
+    bytes of length SIGNAL.size
+    '''
+    nearest = sum(1 << index for index, value in enumerate(signal['nearest']) if value)
+    middle = sum(1 << index for index, value in enumerate(signal['middle']) if value)
+    if fallback:
+        middle |= FALLBACK
+    distances = [NO_DISTANCE] * DISTANCE_SLOTS
+    if 'distances' in signal:
+        middle |= DISTANCES
+        values = signal['distances']['nearest'] + signal['distances']['middle']
+        if len(values) > DISTANCE_SLOTS:
+            raise ValueError('A signal carries at most {} zone distances'.format(DISTANCE_SLOTS))
+        for slot, distance in enumerate(values):
+            if distance != float('inf'):
+                distances[slot] = min(int(round(distance * 100)), NO_DISTANCE - 1)
+    return SIGNAL.pack(frame_id, nearest, middle, *distances)
+
+
+def unpack_signal(data, nearest_zones = 3, middle_zones = 4):
+    '''Description: Decode a control signal packed by pack_signal.
+    Return:
+    frame_id, signal: signal also holds 'fallback': True if it was not computed from the
+                      frame it answers, and the zone distances in metres in 'distances'
+                      if the server measured them.
+    '''
+    frame_id, nearest, middle, *distances = SIGNAL.unpack(data)
+    signal = {'nearest': [(nearest >> index) & 1 for index in range(nearest_zones)],
+              'middle': [(middle >> index) & 1 for index in range(middle_zones)]}
+    if middle & FALLBACK:
+        signal['fallback'] = True
+    if middle & DISTANCES:
+        distances = [float('inf') if distance == NO_DISTANCE else distance / 100.0
+                     for distance in distances]
+        signal['distances'] = {'nearest': distances[:nearest_zones],
+                               'middle': distances[nearest_zones:nearest_zones + middle_zones]}
+    return frame_id, signal
+
+
+def request_encoding(connection, encoding):
+    '''Description: Client side of the hello exchange.
+    Parameters:
+    connection: Connection object.
+    encoding: Encoding the client would like to use.
+    Return:
+    encoding: Encoding accepted by the server.
+    '''
+    connection.sendall(HELLO.pack(MAGIC, VERSION, encoding))
+    reply = bytearray(HELLO.size)
+    recv_exactly(connection, memoryview(reply))
+    magic, version, encoding = HELLO.unpack(reply)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported server protocol version {}'.format(version))
+    return encoding
+
+
+def accept_encoding(connection, supported = tuple(ENCODINGS.values())):
+    '''Description: Server side of the hello exchange. Falls back to raw frames if
+    the requested encoding is not supported.
+    Parameters:
+    connection: Connection object.
+    supported: Encodings the server is willing to decode.
+    Return:
+    encoding: Encoding accepted for this connection.
+    '''
+    hello = bytearray(HELLO.size)
+    recv_exactly(connection, memoryview(hello))
+    magic, version, encoding = HELLO.unpack(hello)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported client protocol version {}'.format(version))
+    if encoding not in supported:
+        encoding = ENCODING_RAW
+    connection.sendall(HELLO.pack(MAGIC, VERSION, encoding))
+    return encoding
+
+
+class TransportStats(object):
+    '''Per frame wire size and coding cost, averaged over all frames seen so far.
+    '''
+    def __init__(self):
+        self.frames = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.coding_time = 0.0
+        self.last = None
+
+    def add(self, raw_bytes, wire_bytes, coding_time):
+        self.frames += 1
+        self.raw_bytes += raw_bytes
+        self.wire_bytes += wire_bytes
+        self.coding_time += coding_time
+        self.last = (raw_bytes, wire_bytes, coding_time)
+
+    def report(self):
+        '''Description: Summarise the counters.
+        Returns:
+        A dict with mean wire size in bytes, compression ratio and mean coding time in ms.
+        '''
+        frames = max(self.frames, 1)
+        return {'frames': self.frames,
+                'wire_bytes': self.wire_bytes / frames,
+                'ratio': self.raw_bytes / max(self.wire_bytes, 1),
+                'coding_ms': self.coding_time / frames * 1000}
+
+    def __str__(self):
+        return ('{frames} frames, {wire_bytes:.0f} bytes/frame, {ratio:.1f}x smaller, '
+                '{coding_ms:.2f} ms/frame').format(**self.report())
+
+
+class FrameEncoder(object):
+    '''A class to encode side by side grayscale frames for the wire.
+    Methods:
+    encode
+    '''
+    def __init__(self, encoding = ENCODING_RAW, quality = 90):
+        '''
+        Parameters:
+        encoding: One of the ENCODING_* constants.
+        quality: JPEG quality, or PNG compression level scaled to 0-100.
+        '''
+        self.encoding = encoding
+        self.quality = quality
+        self.previous = None
+        self.difference = None
+        self.stats = TransportStats()
+
+    def encode(self, frame_id, image, capture_time = None):
+        '''Description: Encode an image.
+        Parameters:
+        frame_id: Sequence number of the frame.
+        image: 2D uint8 image.
+        capture_time: time.time() at which the frame was captured, defaults to now.
+        Return:
+        header, payload: The frame header and a bytes-like payload, to be sent in order.
+        '''
+        start = time.perf_counter()
+        if self.encoding == ENCODING_RAW:
+            payload = memoryview(np.ascontiguousarray(image)).cast('B')
+        elif self.encoding == ENCODING_JPEG:
+            payload = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1]
+        elif self.encoding == ENCODING_PNG:
+            payload = cv2.imencode('.png', image,
+                                   [cv2.IMWRITE_PNG_COMPRESSION, 9 - self.quality * 9 // 100])[1]
+        elif self.encoding == ENCODING_DELTA:
+            payload = self._encode_delta(image)
+        else:
+            raise ValueError('Unknown encoding {}'.format(self.encoding))
+
+        if capture_time is None:
+            capture_time = time.time()
+        header = HEADER.pack(MAGIC, VERSION, self.encoding, image.shape[1], image.shape[0],
+                             frame_id, len(payload), capture_time)
+        self.stats.add(image.nbytes, HEADER.size + len(payload), time.perf_counter() - start)
+        return header, payload
+
+    def _encode_delta(self, image):
+        '''Description: Lossless delta against the previous frame. The byte-wise difference
+        wraps around modulo 256, and is mostly zeros for a still scene so it deflates well.
+        '''
+        if self.previous is None or self.previous.shape != image.shape:
+            self.previous = np.zeros(image.shape, dtype = np.uint8)
+            self.difference = np.empty(image.shape, dtype = np.uint8)
+        np.subtract(image, self.previous, out = self.difference)
+        np.copyto(self.previous, image)
+        return zlib.compress(self.difference, 1)
+
+
+class FrameDecoder(object):
+    '''A class to receive and decode frames sent by FrameEncoder.
+    Methods:
+    recieve_into
+    '''
+    def __init__(self, encoding = ENCODING_RAW):
+        '''
+        Parameters:
+        encoding: Encoding negotiated for the connection.
+        '''
+        self.encoding = encoding
+        self.header = bytearray(HEADER.size)
+        self.header_view = memoryview(self.header)
+        self.payload = bytearray(1 << 16)
+        self.previous = None
+        self.capture_time = None
+        self.stats = TransportStats()
+
+    def recieve_header(self, connection):
+        '''Description: Receive and validate the next frame header.
+        Return:
+        width, height, frame_id, payload_length
+        '''
+        recv_exactly(connection, self.header_view)
+        return self.parse_header(self.header)
+
+    def parse_header(self, header):
+        '''Description: Validate a frame header. The capture time is kept in capture_time.
+        Return:
+        width, height, frame_id, payload_length
+        '''
+        (magic, version, encoding, width, height, frame_id, length,
+         self.capture_time) = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Unsupported frame header version {}'.format(version))
+        if encoding != self.encoding:
+            raise ValueError('Frame encoding {} was not negotiated'.format(encoding))
+        return width, height, frame_id, length
+
+    def recieve_into(self, connection, length, out):
+        '''Description: Receive a payload of the given length and decode it into out.
+        Raw payloads are received straight into out without any copy.
+        Parameters:
+        connection: Connection object.
+        length: Payload length given by the header.
+        out: Preallocated 2D uint8 array of the frame size.
+        '''
+        if self.encoding == ENCODING_RAW:
+            recv_exactly(connection, memoryview(out).cast('B'))
+            self.stats.add(out.nbytes, HEADER.size + length, 0.0)
+            return out
+
+        if len(self.payload) < length:
+            self.payload = bytearray(length)
+        payload = memoryview(self.payload)[:length]
+        recv_exactly(connection, payload)
+        return self.decode_into(payload, out)
+
+    def decode_into(self, payload, out):
+        '''Description: Decode an encoded payload into out.
+        Parameters:
+        payload: Bytes-like payload.
+        out: Preallocated 2D uint8 array of the frame size.
+        '''
+        if self.encoding == ENCODING_RAW:
+            np.copyto(out, np.frombuffer(payload, dtype = np.uint8).reshape(out.shape))
+            self.stats.add(out.nbytes, HEADER.size + len(payload), 0.0)
+            return out
+
+        start = time.perf_counter()
+        if self.encoding in (ENCODING_JPEG, ENCODING_PNG):
+            image = cv2.imdecode(np.frombuffer(payload, dtype = np.uint8), cv2.IMREAD_GRAYSCALE)
+            np.copyto(out, image)
+        elif self.encoding == ENCODING_DELTA:
+            if self.previous is None or self.previous.shape != out.shape:
+                self.previous = np.zeros(out.shape, dtype = np.uint8)
+            difference = np.frombuffer(zlib.decompress(payload), dtype = np.uint8)
+            np.add(self.previous, difference.reshape(out.shape), out = self.previous)
+            np.copyto(out, self.previous)
+        else:
+            raise ValueError('Unknown encoding {}'.format(self.encoding))
+        self.stats.add(out.nbytes, HEADER.size + len(payload), time.perf_counter() - start)
+        return out
@@ -1,16 +1,33 @@
-import sys, os, struct, pickle, socket
+import socket
 
 import cv2
 import numpy as np
-import sounddevice as sd
 
 from image_loader import CaptureImage
 from audio import AudioFeedback
+from protocol import (ENCODINGS, SIGNAL, FrameEncoder, recv_exactly, request_encoding,
+                      unpack_signal)
 
 IMAGE_WIDTH = 640
 IMAGE_HEIGHT = 480
 LEFT_CAM = 0
 RIGHT_CAM = 1
+CAMERA_FPS = 30
+# Ask the cameras for single channel frames, e.g. 'GREY' or 'YUYV', to skip colour conversion
+CAMERA_FOURCC = None
+# Frames queued by the camera driver, 1 always delivers the most recent frame
+CAMERA_BUFFER_SIZE = 1
+
+# Frame encoding requested from the server: raw, jpeg, png or delta. raw matches the
+# original wire format; jpeg is lossy and shifts disparity, so enable it deliberately
+ENCODING = 'raw'
+JPEG_QUALITY = 90
+# Stream with the asyncio protocol, keeping several frames in flight. Needed for the
+# server's PIPELINE_MODE or ASYNC_MODE to overlap work on consecutive frames.
+ASYNC_MODE = False
+FRAMES_IN_FLIGHT = 3
+# Number of frames between two reports of wire size and encoding cost
+TRANSPORT_REPORT_INTERVAL = 100
 
 def initialise_network(addr, port):
     '''Description: A function to initialise a streaming connection.
@@ -22,64 +39,120 @@ def initialise_network(addr, port):
     connection.connect((addr, port))
     return connection
 
-def send(connection, data):
+def send(connection, encoder, frame_id, data, capture_time = None):
     '''Description: A simple protocol to send images.
-    First send the size of the images (2), then send the images.
+    First send the frame header, then send the encoded images.
     Parameters:
     connection: Connection object received from initialisation function.
-    data: The image data to be sent to server.
+    encoder: FrameEncoder using the encoding negotiated with the server.
+    frame_id: Sequence number of the frame.
+    data: The concatenated images to be sent to server.
+    capture_time: time.time() at which the images were captured.
     '''
-    connection.send(struct.pack('<L', 640*480*2))
-    connection.send(data)
+    header, payload = encoder.encode(frame_id, data, capture_time)
+    connection.sendall(header)
+    connection.sendall(payload)
 
 def recieve(connection):
     '''
     Description: A simple protocol for receiving control signals.
-    First obtain the size of signal, then receive the signal.
+    Signals are fixed size records tagged with the frame id they answer.
     Parameters:
     connection: Connection object received from initialisation function.
     Returns:
+    frame_id: Sequence number of the frame the signal was computed from.
     signal: Control signal sent by the server.
     '''
-    signal_len = struct.unpack('<I', connection.recv(struct.calcsize('<I')))[0]
-    
-    signal = b''
-    length = 0
-    while length < signal_len:
-        chunk = connection.recv(int(signal_len/2))
-        signal += chunk
-        length += sys.getsizeof(chunk)
-        
-    signal = pickle.loads(signal)
-    return signal
+    data = bytearray(SIGNAL.size)
+    recv_exactly(connection, memoryview(data))
+    return unpack_signal(data)
+
+def next_pair(image_loader):
+    '''Description: Wait for the next stereo pair, including while the cameras start and
+    have not delivered any pair yet.
+    Parameters:
+    image_loader: Started CaptureImage.
+    Returns:
+    left_img, right_img: The pair, its capture time is in image_loader.read_timestamp.
+    '''
+    left_img, right_img = image_loader.load_images()
+    while left_img is None:
+        left_img, right_img = image_loader.load_images()
+    return left_img, right_img
 
-def preprocess(left_img, right_img):
+def preprocess(left_img, right_img, out = None):
     '''Description: Preprocess the images, by converting to gray scale and concatenating them.
+    Each image is converted straight into its half of the output, without intermediate copies.
     Parameters:
-    left_img: Left image obtained from webcam
+    left_img: Left image obtained from webcam, BGR, single channel, or YUYV with the
+              luma in the first channel.
     right_img: Right image obtained from webcam
+    out: Optional preallocated (height, 2 * width) uint8 buffer, reused across frames.
     Return:
     data: Left and right images concatenated.
     '''
-    left_img = cv2.cvtColor(left_img, cv2.COLOR_BGR2GRAY)
-    right_img = cv2.cvtColor(right_img, cv2.COLOR_BGR2GRAY)
-
-    data = np.hstack((left_img, right_img)).astype(np.uint8)
-    return data
+    height, width = left_img.shape[:2]
+    if out is None:
+        out = np.empty((height, 2 * width), dtype = np.uint8)
+    for img, half in ((left_img, out[:, :width]), (right_img, out[:, width:])):
+        if img.ndim == 2:
+            np.copyto(half, img)
+        elif img.shape[2] == 2:
+            np.copyto(half, img[:, :, 0])
+        else:
+            cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst = half)
+    return out
 
 
 def main():
-    image_loader = CaptureImage(LEFT_CAM, RIGHT_CAM)
+    image_loader = CaptureImage(LEFT_CAM, RIGHT_CAM, IMAGE_WIDTH, IMAGE_HEIGHT, CAMERA_FPS,
+                                CAMERA_BUFFER_SIZE, CAMERA_FOURCC)
     image_loader.start()
-    connection = initialise_network('Suhas-G', 8000)
     feedback = AudioFeedback()
+
+    if ASYNC_MODE:
+        import asyncio, itertools
+        from async_protocol import AsyncClient
+
+        # Frames are encoded and written before the next capture, and the transport copies
+        # what it could not send at once, so a ring sized to the frames in flight is ample
+        buffers = [np.empty((IMAGE_HEIGHT, 2 * IMAGE_WIDTH), dtype = np.uint8)
+                   for _ in range(FRAMES_IN_FLIGHT)]
+        slots = itertools.cycle(range(FRAMES_IN_FLIGHT))
+
+        def capture():
+            left_img, right_img = next_pair(image_loader)
+            index = next(slots)
+            data = buffers[index]
+            if left_img.shape[:2] != (data.shape[0], data.shape[1] // 2):
+                data = buffers[index] = np.empty((left_img.shape[0], 2 * left_img.shape[1]),
+                                                 dtype = np.uint8)
+            return preprocess(left_img, right_img, data)
+
+        client = AsyncClient(capture, lambda frame_id, signal: feedback.update(signal['nearest']),
+                             ENCODINGS[ENCODING], FRAMES_IN_FLIGHT, JPEG_QUALITY)
+        asyncio.run(client.run('Suhas-G', 8000))
+        feedback.stop()
+        return
+
+    connection = initialise_network('Suhas-G', 8000)
+    encoding = request_encoding(connection, ENCODINGS[ENCODING])
+    encoder = FrameEncoder(encoding, quality = JPEG_QUALITY)
     print('Connection initialised...')
+    frame_id = 0
+    data = np.empty((IMAGE_HEIGHT, 2 * IMAGE_WIDTH), dtype = np.uint8)
     while True:
-        left_img, right_img = image_loader.load_images()
-        data = preprocess(left_img, right_img)
-        send(connection, data.tostring())
-        signal = recieve(connection)
-        feedback.update(signal)
+        left_img, right_img = next_pair(image_loader)
+        capture_time = image_loader.read_timestamp
+        if left_img.shape[:2] != (data.shape[0], data.shape[1] // 2):
+            data = np.empty((left_img.shape[0], 2 * left_img.shape[1]), dtype = np.uint8)
+        data = preprocess(left_img, right_img, data)
+        frame_id += 1
+        send(connection, encoder, frame_id, data, capture_time)
+        if frame_id % TRANSPORT_REPORT_INTERVAL == 0:
+            print('Transport: {}'.format(encoder.stats))
+        _, signal = recieve(connection)
+        feedback.update(signal['nearest'])
         
         
     feedback.stop()
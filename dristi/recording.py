@@ -0,0 +1,262 @@
+'''
+Description: Record the frames received by the server, with their timestamps and the signals
+            sent back, and replay them later to reproduce an incident.
+            A session file is a header followed by records. A frame record holds the stereo
+            frame exactly as received, left and right side by side, and a signal record holds
+            the packed signal answered for a frame. Records are appended in chunks through a
+            buffered file, and an index of all records is written on close. A session which
+            was not closed, e.g. after a crash, is indexed again by scanning its records.
+            Replay memory-maps the file, so frames are handed out as zero-copy views.
+            Usage: python recording.py <session> [--speed S] [--calibration folder]
+'''
+
+
+import sys, time, struct, argparse
+from threading import Lock
+
+import numpy as np
+
+from protocol import SIGNAL, pack_signal, unpack_signal
+
+
+MAGIC = b'DRSS'
+# Version 2 records signals with their zone distances
+VERSION = 2
+INDEX_MAGIC = b'DRSI'
+
+RECORD_FRAME = 0
+RECORD_SIGNAL = 1
+
+# magic, version
+FILE_HEADER = struct.Struct('<4sB')
+# record type, frame id, timestamp, height, width, channels, payload length
+RECORD = struct.Struct('<BIdHHBI')
+# index offset, number of records, magic
+TRAILER = struct.Struct('<QI4s')
+INDEX = np.dtype([('type', '<u1'), ('frame_id', '<u4'), ('timestamp', '<f8'),
+                  ('offset', '<u8')])
+
+
+class SessionRecorder(object):
+    '''A class to append received frames and the signals sent back to a session file.
+    Methods:
+    write_frame
+    write_signal
+    close
+    '''
+    def __init__(self, filename, chunk_size = 1 << 22):
+        '''
+        Parameters:
+        filename: Session file, overwritten if it exists.
+        chunk_size: Size in bytes of the write buffer, records reach the disk in chunks.
+        '''
+        self.file = open(filename, 'wb', buffering = chunk_size)
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.offset = FILE_HEADER.size
+        self.index = []
+        self.lock = Lock()
+
+    def _write(self, kind, frame_id, timestamp, shape, payload):
+        height, width, channels = shape
+        with self.lock:
+            self.index.append((kind, frame_id, timestamp, self.offset))
+            self.file.write(RECORD.pack(kind, frame_id, timestamp, height, width, channels,
+                                        len(payload)))
+            self.file.write(payload)
+            self.offset += RECORD.size + len(payload)
+
+    def write_frame(self, frame_id, left_img, right_img, timestamp = None):
+        '''Description: Record a received stereo frame.
+        Parameters:
+        frame_id: Sequence number of the frame.
+        left_img, right_img: Images as received, before rectification.
+        timestamp: time.time() at which the frame was received, now by default.
+        '''
+        frame = np.hstack((left_img, right_img))
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        self._write(RECORD_FRAME, frame_id, time.time() if timestamp is None else timestamp,
+                    (frame.shape[0], frame.shape[1], channels), memoryview(frame).cast('B'))
+
+    def write_signal(self, frame_id, signal, fallback = False):
+        '''Description: Record the signal sent back for a frame.
+        Parameters:
+        fallback: The last known signal was sent, the frame was dropped.
+        '''
+        self._write(RECORD_SIGNAL, frame_id, time.time(), (0, 0, 0),
+                    pack_signal(frame_id, signal, fallback))
+
+    def close(self):
+        '''Description: Write the index and close the file.
+        '''
+        with self.lock:
+            index = np.array(self.index, dtype = INDEX)
+            self.file.write(index.tobytes())
+            self.file.write(TRAILER.pack(self.offset, len(index), INDEX_MAGIC))
+            self.file.close()
+
+
+class SessionReplay(object):
+    '''
+    A class to replay a recorded session, with the same interface as ReadImages.
+    Frames are zero-copy read only views into the memory-mapped file.
+    Methods defined here:
+    @public: load_images()
+             start()
+             stop()
+    '''
+    def __init__(self, filename, speed = 1.0):
+        '''
+        Parameters:
+        filename: Session file written by SessionRecorder.
+        speed: Replay speed relative to real time, None replays as fast as possible.
+        '''
+        self.data = np.memmap(filename, dtype = np.uint8, mode = 'r')
+        magic, version = FILE_HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} session file'.format(filename, VERSION))
+
+        index = self._read_index()
+        frames = index[index['type'] == RECORD_FRAME]
+        self.offsets = frames['offset']
+        self.frame_ids = frames['frame_id']
+        self.timestamps = frames['timestamp']
+        self.signals = {}
+        for offset in index['offset'][index['type'] == RECORD_SIGNAL]:
+            frame_id, signal = unpack_signal(self.data[offset + RECORD.size:
+                                                       offset + RECORD.size + SIGNAL.size])
+            self.signals[frame_id] = signal
+
+        self.speed = speed
+        self.position = 0
+        self.frame_id = None
+        self.timestamp = None
+        self.started = None
+
+    def _read_index(self):
+        '''Description: Read the index written on close, or rebuild it by scanning the records.
+        '''
+        if len(self.data) >= FILE_HEADER.size + TRAILER.size:
+            offset, count, magic = TRAILER.unpack_from(self.data, len(self.data) - TRAILER.size)
+            end = offset + count * INDEX.itemsize + TRAILER.size
+            if magic == INDEX_MAGIC and end == len(self.data):
+                return np.frombuffer(self.data, dtype = INDEX, count = count, offset = offset)
+
+        records = []
+        offset = FILE_HEADER.size
+        while offset + RECORD.size <= len(self.data):
+            kind, frame_id, timestamp, _, _, _, length = RECORD.unpack_from(self.data, offset)
+            if offset + RECORD.size + length > len(self.data):
+                break
+            records.append((kind, frame_id, timestamp, offset))
+            offset += RECORD.size + length
+        return np.array(records, dtype = INDEX)
+
+    def __len__(self):
+        '''Description: Number of frames not loaded yet.
+        '''
+        return len(self.offsets) - self.position
+
+    def load_images(self):
+        '''Description: Returns the next left and right images, waiting until they are due
+        when replaying at a given speed.
+        '''
+        if self.position >= len(self.offsets):
+            sys.exit()
+        offset = int(self.offsets[self.position])
+        self.frame_id = int(self.frame_ids[self.position])
+        self.timestamp = float(self.timestamps[self.position])
+        self.position += 1
+
+        _, _, _, height, width, channels, length = RECORD.unpack_from(self.data, offset)
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        start = offset + RECORD.size
+        frame = self.data[start:start + length].reshape(shape)
+
+        if self.speed:
+            if self.started is None:
+                self.started = (time.monotonic(), self.timestamp)
+            due = self.started[0] + (self.timestamp - self.started[1]) / self.speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return frame[:, :width // 2], frame[:, width // 2:]
+
+    def start(self):
+        '''Description: Dummy method for compatibility.
+        '''
+        return
+
+    def stop(self):
+        '''Description: Dummy method for compatibility.
+        '''
+        return
+
+
+def replay_session(filename, calibration_folder = None, speed = None):
+    '''Description: Run the server processing over a recorded session, and compare the
+    signals with the recorded ones.
+    Parameters:
+    filename: Session file.
+    calibration_folder: Calibration folder, the server's default if None.
+    speed: Replay speed relative to real time, None replays as fast as possible.
+    Return:
+    report: dict with the number of frames, fps and frames whose signal differs.
+    '''
+    from load_calibration import Calibration
+    from laptop_server import (CALIBRATION_FOLDER, process_frame, create_disparity_handler,
+                               create_segmentation)
+
+    replay = SessionReplay(filename, speed)
+    calibration = None
+    # Created like the server's, with its ROI, temporal and adaptive settings, once the
+    # calibration is known
+    disparity_handler = None
+    segmentation = None
+
+    frames = len(replay)
+    mismatches = []
+    start = time.perf_counter()
+    for _ in range(frames):
+        left_img, right_img = replay.load_images()
+        if calibration is None:
+            calibration = Calibration(left_img.shape[1::-1])
+            calibration.load_calibration_files(calibration_folder or CALIBRATION_FOLDER)
+            disparity_handler = create_disparity_handler(calibration)
+            segmentation = create_segmentation(calibration)
+        signal = process_frame(calibration, disparity_handler, segmentation, left_img, right_img)
+        recorded = replay.signals.get(replay.frame_id)
+        # A frame the server dropped was answered with an older signal. Only zone flags are
+        # compared, recorded distances are rounded to centimetres.
+        if (recorded is not None and not recorded.get('fallback') and
+                (recorded['nearest'], recorded['middle']) != (signal['nearest'],
+                                                              signal['middle'])):
+            mismatches.append(replay.frame_id)
+    elapsed = time.perf_counter() - start
+    if disparity_handler is not None:
+        disparity_handler.close()
+
+    return {'frames': frames,
+            'fps': frames / elapsed if elapsed else 0.0,
+            'recorded_fps': float((frames - 1) / (replay.timestamps[-1] - replay.timestamps[0]))
+                            if frames > 1 and replay.timestamps[-1] > replay.timestamps[0] else 0.0,
+            'mismatches': mismatches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replay a recorded server session.')
+    parser.add_argument('session', help = 'Session file written by the server')
+    parser.add_argument('--speed', type = float, default = None,
+                        help = 'Replay speed relative to real time, as fast as possible if omitted')
+    parser.add_argument('--calibration', help = 'Calibration folder')
+    args = parser.parse_args()
+
+    report = replay_session(args.session, args.calibration, args.speed)
+    print('{frames} frames replayed at {fps:.1f} fps (recorded at {recorded_fps:.1f} fps), '
+          '{count} signals differ from the recording'.format(count = len(report['mismatches']),
+                                                              **report))
+    if report['mismatches']:
+        print('Frames: {}'.format(report['mismatches'][:20]))
+
+
+if __name__ == '__main__':
+    main()
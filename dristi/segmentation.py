@@ -0,0 +1,112 @@
+import cv2
+import numpy as np
+
+
+class SegmentationEngine(object):
+    '''
+    A class to turn a disparity map into a control signal without per frame allocations.
+    Each proximity band is segmented with a single cv2.inRange pass on the uint8 disparity
+    into a reused mask, cleaned up by an in-place morphological open and close, and each
+    zone is marked occupied when the area enclosed by the external contour of a blob is more
+    than a given fraction of the zone, the original contour area test. Contours run through
+    boundary pixel centres, so no contour can enclose more than the box around all set
+    pixels; zones whose box is too small are decided without tracing contours.
+    Methods:
+    apply_thresholds
+    apply_segmentation
+    segment
+    '''
+    def __init__(self, nearest_range = (190, 255), middle_range = (150, 180),
+                 nearest_zones = 3, middle_zones = 4, fraction = 1 / 3, single_blob = True,
+                 kernel_size = 5):
+        '''
+        Parameters:
+        nearest_range: Inclusive (lower, higher) disparity thresholds of the nearest band.
+        middle_range: Inclusive (lower, higher) disparity thresholds of the middle band.
+        nearest_zones: Number of vertical zones the nearest band is divided into.
+        middle_zones: Number of vertical zones the middle band is divided into.
+        fraction: Fraction of a zone that must be covered for it to be occupied.
+        single_blob: Require a single contour to enclose the fraction, rather than all
+                     contours together.
+        kernel_size: Size of the square structuring element used to clean up the masks.
+        '''
+        self.nearest_range = nearest_range
+        self.middle_range = middle_range
+        self.nearest_zones = nearest_zones
+        self.middle_zones = middle_zones
+        self.fraction = fraction
+        # Zone areas are divided by this, as in the original w * h / 3, for identical rounding
+        self.divisor = 1 / fraction
+        self.single_blob = single_blob
+        self.kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        self.shape = None
+
+    def _allocate(self, shape):
+        '''Description: (Re)allocate the mask buffers and zone bounds for a frame size.
+        '''
+        self.shape = shape
+        self.nearest = np.empty(shape, dtype = np.uint8)
+        self.middle = np.empty(shape, dtype = np.uint8)
+        self.scratch = np.empty(shape, dtype = np.uint8)
+        self.nearest_bounds = self._zone_bounds(shape[1], self.nearest_zones)
+        self.middle_bounds = self._zone_bounds(shape[1], self.middle_zones)
+
+    @staticmethod
+    def _zone_bounds(width, zones):
+        '''Description: Column bounds of each zone, split the same way as np.array_split.
+        '''
+        size, extra = divmod(width, zones)
+        bounds = [0]
+        for zone in range(zones):
+            bounds.append(bounds[-1] + size + (1 if zone < extra else 0))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def apply_thresholds(self, disparity):
+        '''Description: Segment objects present at the 2 proximity levels.
+        Parameters:
+        disparity: uint8 disparity map
+        Return:
+        nearest, middle: uint8 masks (0 or 255), valid until the next call.
+        '''
+        if self.shape != disparity.shape:
+            self._allocate(disparity.shape)
+        for mask, (lower, higher) in ((self.nearest, self.nearest_range),
+                                      (self.middle, self.middle_range)):
+            cv2.inRange(disparity, lower, higher, dst = mask)
+            cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel, dst = self.scratch)
+            cv2.morphologyEx(self.scratch, cv2.MORPH_CLOSE, self.kernel, dst = mask)
+        return self.nearest, self.middle
+
+    def apply_segmentation(self, nearest, middle):
+        '''Description: Decide the occupancy of every zone from the area of its contours.
+        Parameters:
+        nearest: Mask of objects of nearest proximity
+        middle: Mask of objects present at mid-level proximity
+        Return:
+        signal: Control signal, {'nearest': [...], 'middle': [...]}.
+        '''
+        if self.shape != nearest.shape:
+            self._allocate(nearest.shape)
+        return {'nearest': self._occupancy(nearest, self.nearest_bounds),
+                'middle': self._occupancy(middle, self.middle_bounds)}
+
+    def _occupancy(self, mask, bounds):
+        height = mask.shape[0]
+        occupancy = []
+        for start, end in bounds:
+            zone = mask[:, start:end]
+            area = height * (end - start) / self.divisor
+            _, _, width, rows = cv2.boundingRect(zone)
+            occupied = (width - 1) * (rows - 1) > area
+            if occupied:
+                contours = cv2.findContours(zone, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+                areas = [cv2.contourArea(contour) for contour in contours]
+                occupied = (max(areas) if self.single_blob else sum(areas)) > area
+            occupancy.append(1 if occupied else 0)
+        return occupancy
+
+    def segment(self, disparity):
+        '''Description: Compute the control signal for a disparity map.
+        '''
+        nearest, middle = self.apply_thresholds(disparity)
+        return self.apply_segmentation(nearest, middle)
@@ -0,0 +1,176 @@
+import time
+
+import cv2
+import numpy as np
+
+
+class TemporalDisparity(object):
+    '''
+    A class to reuse work between consecutive frames when the scene does not change.
+    Every horizontal strip of a rectified frame is compared, on downsampled copies, with the
+    frame its current disparity was computed from, so that slow changes add up until they
+    are noticed. If no strip changed, the previous disparity and signal are reused;
+    otherwise only the changed strips are recomputed, or the whole frame if all changed.
+    A strip is recomputed anyway once it has been reused for max_age frames.
+    An unchanged frame gets the very same disparity object as the previous one, which is
+    how segment knows the signal can be reused; returned maps are never modified later, so
+    frames can wait in a pipeline queue while the next ones are computed.
+    Optionally the disparity is smoothed over time with an exponential moving average, to
+    stop zones from toggling because of flicker.
+    Parameters:
+    disparity_handler: DisparityCreator instance, without a roi.
+    threshold: Mean absolute grey level difference above which a strip has changed.
+    strips: Number of horizontal strips.
+    overlap: Number of rows each recomputed strip is extended by on both sides.
+    smoothing: Weight of the newest disparity in the moving average, 0 disables smoothing.
+    sample: Downsampling factor of the images used to measure changes.
+    max_age: Number of frames after which a reused strip is recomputed regardless.
+    Methods:
+    get_disparity
+    segment
+    report
+    close
+    '''
+    def __init__(self, disparity_handler, threshold = 2.0, strips = 4, overlap = 16,
+                 smoothing = 0.0, sample = 4, max_age = 30):
+        self.disparity_handler = disparity_handler
+        self.threshold = threshold
+        self.strips = strips
+        self.overlap = overlap
+        self.smoothing = smoothing
+        self.sample = sample
+        self.max_age = max_age
+
+        self.shape = None
+        self.disparity = None
+        self.output = None
+        self.signal = None
+        self.signal_disparity = None
+
+        self.frames = 0
+        self.hits = 0
+        self.partial = 0
+        self.full = 0
+        self.recomputed_strips = 0
+        self.full_time = None
+        self.time_saved = 0.0
+
+    def _allocate(self, shape):
+        self.shape = shape
+        small_shape = (shape[0] // self.sample, shape[1] // self.sample)
+        self.small = [np.empty(small_shape, dtype = np.uint8) for _ in range(2)]
+        # Downsampled frame every strip of the current disparity was computed from
+        self.reference = [np.empty(small_shape, dtype = np.uint8) for _ in range(2)]
+        self.difference = np.empty(small_shape, dtype = np.uint8)
+        self.bounds = np.linspace(0, shape[0], self.strips + 1).astype(int)
+        self.ages = np.zeros(self.strips, dtype = int)
+        self.average = np.empty(shape, dtype = np.float32)
+        self.disparity = None
+        self.output = None
+
+    def _changed_strips(self, left_img, right_img):
+        '''Description: Indices of the strips whose content changed since their disparity
+        was computed, or which have been reused for too long. The reference of these strips
+        is updated, as they are about to be recomputed.
+        '''
+        changed = set()
+        if self.disparity is None:
+            changed.update(range(self.strips))
+        else:
+            changed.update(np.flatnonzero(self.ages >= self.max_age))
+        for img, small, reference in zip((left_img, right_img), self.small, self.reference):
+            cv2.resize(img, small.shape[::-1], dst = small, interpolation = cv2.INTER_NEAREST)
+            if self.disparity is None:
+                continue
+            cv2.absdiff(small, reference, dst = self.difference)
+            for index in range(self.strips):
+                start, end = self.bounds[index] // self.sample, self.bounds[index + 1] // self.sample
+                if cv2.mean(self.difference[start:end])[0] > self.threshold:
+                    changed.add(index)
+
+        self.ages += 1
+        for index in changed:
+            start, end = self.bounds[index] // self.sample, self.bounds[index + 1] // self.sample
+            for small, reference in zip(self.small, self.reference):
+                reference[start:end] = small[start:end]
+            self.ages[index] = 0
+        return sorted(changed)
+
+    def get_disparity(self, left_img, right_img):
+        '''Get disparity map for corresponding left and right images.
+        Parameters:
+        left_img: Left image
+        right_img: Right image
+        '''
+        start = time.perf_counter()
+        if self.shape != left_img.shape[:2]:
+            self._allocate(left_img.shape[:2])
+        self.frames += 1
+        changed = self._changed_strips(left_img, right_img)
+
+        if len(changed) == self.strips:
+            self.full += 1
+            self.disparity = self.disparity_handler.get_disparity(left_img, right_img)
+        elif changed:
+            self.partial += 1
+            self.recomputed_strips += len(changed)
+            self.disparity = self.disparity.copy()
+            height = left_img.shape[0]
+            for index in changed:
+                first, last = self.bounds[index], self.bounds[index + 1]
+                top, bottom = max(0, first - self.overlap), min(height, last + self.overlap)
+                strip = self.disparity_handler.get_disparity(left_img[top:bottom],
+                                                             right_img[top:bottom])
+                self.disparity[first:last] = strip[first - top:last - top]
+        else:
+            self.hits += 1
+
+        elapsed = time.perf_counter() - start
+        if len(changed) == self.strips:
+            self.full_time = elapsed if self.full_time is None else 0.9 * self.full_time + 0.1 * elapsed
+        elif self.full_time is not None:
+            self.time_saved += max(0.0, self.full_time - elapsed)
+
+        if not changed and self.output is not None:
+            return self.output
+        if not self.smoothing:
+            self.output = self.disparity
+        else:
+            if self.output is None:
+                self.average[:] = self.disparity
+            else:
+                cv2.accumulateWeighted(self.disparity, self.average, self.smoothing)
+            self.output = cv2.convertScaleAbs(self.average)
+        return self.output
+
+    def segment(self, segmentation, disparity):
+        '''Description: Compute the control signal, reusing the previous one if the disparity
+        is the one it was computed from, i.e. the frame was unchanged. Only called from a
+        single thread, which may lag behind the one calling get_disparity.
+        Parameters:
+        segmentation: SegmentationEngine instance.
+        disparity: Disparity returned by get_disparity.
+        '''
+        if disparity is not self.signal_disparity:
+            self.signal = segmentation.segment(disparity)
+            self.signal_disparity = disparity
+        return self.signal
+
+    def report(self):
+        '''Description: Summarise the counters.
+        Returns:
+        A dict with the fraction of frames reused entirely, recomputed partially or in full,
+        and the estimated computation time saved in seconds.
+        '''
+        frames = max(self.frames, 1)
+        return {'frames': self.frames,
+                'hit_rate': self.hits / frames,
+                'partial_rate': self.partial / frames,
+                'full_rate': self.full / frames,
+                'recomputed_strips': self.recomputed_strips,
+                'time_saved': self.time_saved}
+
+    def close(self):
+        '''Shut down the wrapped disparity handler.
+        '''
+        self.disparity_handler.close()
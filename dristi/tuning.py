@@ -0,0 +1,207 @@
+'''
+Description: Sweep the stereo matcher and WLS filter parameters over a replay set, and find
+            the configurations which trade latency against quality best.
+            Every configuration is timed on the same rectified pairs, in parallel processes,
+            and its zone decisions are compared with those of a reference configuration.
+            The Pareto frontier of latency against agreement is reported, and the fastest
+            frontier profile above a given agreement can be written for
+            DisparityCreator.from_profile or laptop_server.DISPARITY_PROFILE.
+            Usage: python tuning.py [--images folder | --session file] [--calibration folder]
+                                    [--grid grid.json] [--reference profile.json]
+                                    [--min-agreement 0.95 --profile-out profile.json]
+'''
+
+
+import os, json, time, argparse, itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+from disparity import DEFAULT_SGBM, DEFAULT_PROFILE, DisparityCreator, load_profile
+
+
+# Values tried for every parameter. Keys are profile keys or cv2.StereoSGBM_create parameters.
+# The smoothness penalties P1 and P2 are given for the default block size, see expand_grid.
+DEFAULT_GRID = {'num_disparities': [32, 48, 64],
+                'blockSize': [3, 5],
+                'P2': [1300, 2600],
+                'mode': [cv2.STEREO_SGBM_MODE_SGBM, cv2.STEREO_SGBM_MODE_HH,
+                         cv2.STEREO_SGBM_MODE_SGBM_3WAY],
+                'Lambda': [8000, 16000],
+                'sigma': [1.5, 7]}
+
+PAIRS = None
+
+
+def expand_grid(grid):
+    '''Description: Every combination of the values of a grid, as disparity profiles.
+    The matching cost grows with the block area, so P1 and P2, swept or default, are given
+    for the default block size and scaled by the block area of every profile.
+    '''
+    unknown = set(grid) - set(DEFAULT_PROFILE) - set(DEFAULT_SGBM)
+    if unknown:
+        raise ValueError('Unknown parameters {}'.format(sorted(unknown)))
+    profiles = []
+    for values in itertools.product(*grid.values()):
+        profile = dict(DEFAULT_PROFILE, sgbm = {})
+        for key, value in zip(grid, values):
+            if key in DEFAULT_PROFILE:
+                profile[key] = value
+            else:
+                profile['sgbm'][key] = value
+        block_size = profile['sgbm'].get('blockSize', DEFAULT_SGBM['blockSize'])
+        if block_size != DEFAULT_SGBM['blockSize']:
+            area = (block_size / DEFAULT_SGBM['blockSize']) ** 2
+            for key in ('P1', 'P2'):
+                profile['sgbm'][key] = int(round(profile['sgbm'].get(key, DEFAULT_SGBM[key]) *
+                                                 area))
+        profiles.append(profile)
+    return profiles
+
+
+def _init_worker(pairs):
+    global PAIRS
+    PAIRS = pairs
+    cv2.setNumThreads(1)
+
+
+def evaluate(profile):
+    '''Description: Time a profile on the worker's pairs, and collect its zone decisions.
+    Return:
+    latencies, flags: Seconds per pair, and the list of zone flags of every pair.
+    '''
+    from segmentation import SegmentationEngine
+
+    disparity_handler = DisparityCreator(**profile)
+    segmentation = SegmentationEngine()
+    disparity_handler.get_disparity(*PAIRS[0])
+    latencies = []
+    flags = []
+    for left_img, right_img in PAIRS:
+        start = time.perf_counter()
+        disparity = disparity_handler.get_disparity(left_img, right_img)
+        latencies.append(time.perf_counter() - start)
+        signal = segmentation.segment(disparity)
+        flags.append(signal['nearest'] + signal['middle'])
+    return latencies, flags
+
+
+def agreement(flags, reference):
+    '''Description: Fraction of zone decisions equal to the reference ones.
+    '''
+    agreeing = sum(flag == reference_flag
+                   for pair_flags, reference_flags in zip(flags, reference)
+                   for flag, reference_flag in zip(pair_flags, reference_flags))
+    return agreeing / max(sum(len(pair_flags) for pair_flags in reference), 1)
+
+
+def pareto_frontier(results):
+    '''Description: Results which no other result beats on both latency and agreement,
+    from the fastest to the most accurate.
+    '''
+    frontier = []
+    for result in sorted(results, key = lambda result: (result['latency_ms'],
+                                                        -result['agreement'])):
+        if not frontier or result['agreement'] > frontier[-1]['agreement']:
+            frontier.append(result)
+    return frontier
+
+
+def sweep(pairs, profiles, reference = None, workers = None):
+    '''Description: Evaluate every profile on the pairs in parallel processes.
+    Parameters:
+    pairs: List of rectified grayscale (left, right) pairs.
+    profiles: List of disparity profiles, see expand_grid.
+    reference: Profile whose zone decisions are taken as correct, DEFAULT_PROFILE if None.
+    workers: Number of processes, defaults to the number of cores.
+    Return:
+    report: dict with the reference, every result and the Pareto frontier.
+    '''
+    reference = reference or dict(DEFAULT_PROFILE)
+    with ProcessPoolExecutor(max_workers = workers or os.cpu_count(),
+                             mp_context = get_context('spawn'),
+                             initializer = _init_worker, initargs = (pairs,)) as executor:
+        _, reference_flags = executor.submit(evaluate, reference).result()
+        results = []
+        for profile, (latencies, flags) in zip(profiles, executor.map(evaluate, profiles)):
+            results.append({'profile': profile,
+                            'latency_ms': float(np.mean(latencies) * 1000),
+                            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+                            'agreement': agreement(flags, reference_flags)})
+    return {'reference': reference, 'pairs': len(pairs), 'results': results,
+            'frontier': pareto_frontier(results)}
+
+
+def load_replay_pairs(images = None, session = None, calibration_folder = None, count = 30):
+    '''Description: Load grayscale pairs from a folder of images or a recorded session,
+    rectified with the calibration if given. Synthetic pairs are used if neither is given.
+    '''
+    from benchmark import synthetic_pairs, load_pairs
+
+    if images:
+        pairs = load_pairs(images, count)
+    elif session:
+        from recording import SessionReplay
+        replay = SessionReplay(session, speed = None)
+        pairs = []
+        for _ in range(min(count, len(replay))):
+            left_img, right_img = replay.load_images()
+            if left_img.ndim == 3:
+                left_img = cv2.cvtColor(left_img, cv2.COLOR_BGR2GRAY)
+                right_img = cv2.cvtColor(right_img, cv2.COLOR_BGR2GRAY)
+            pairs.append((np.ascontiguousarray(left_img), np.ascontiguousarray(right_img)))
+    else:
+        return synthetic_pairs(count)
+
+    if calibration_folder and pairs:
+        from load_calibration import Calibration
+        calibration = Calibration(pairs[0][0].shape[1::-1])
+        calibration.load_calibration_files(calibration_folder)
+        pairs = [(calibration.remap('left', left_img), calibration.remap('right', right_img))
+                 for left_img, right_img in pairs]
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Sweep disparity parameters.')
+    parser.add_argument('--images', help = 'Folder of left/right images')
+    parser.add_argument('--session', help = 'Session file recorded by the server')
+    parser.add_argument('--calibration', help = 'Calibration folder to rectify the pairs with')
+    parser.add_argument('--count', type = int, default = 30, help = 'Number of pairs used')
+    parser.add_argument('--grid', help = 'JSON file of parameter name to list of values')
+    parser.add_argument('--reference', help = 'Profile taken as correct, the defaults if omitted')
+    parser.add_argument('--workers', type = int, help = 'Number of processes')
+    parser.add_argument('--output', help = 'File to write the JSON report to')
+    parser.add_argument('--min-agreement', type = float, default = 0.95,
+                        help = 'Agreement required from the profile written to --profile-out')
+    parser.add_argument('--profile-out', help = 'File to write the chosen profile to')
+    args = parser.parse_args()
+
+    grid = DEFAULT_GRID
+    if args.grid:
+        with open(args.grid) as file:
+            grid = json.load(file)
+    reference = load_profile(args.reference) if args.reference else None
+    pairs = load_replay_pairs(args.images, args.session, args.calibration, args.count)
+    report = sweep(pairs, expand_grid(grid), reference, args.workers)
+
+    for result in report['frontier']:
+        print('{latency_ms:8.1f} ms  {agreement:6.1%}  {profile}'.format(**result))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent = 2)
+    if args.profile_out:
+        chosen = [result for result in report['frontier']
+                  if result['agreement'] >= args.min_agreement]
+        if not chosen:
+            raise SystemExit('No profile reaches {:.1%} agreement'.format(args.min_agreement))
+        with open(args.profile_out, 'w') as file:
+            json.dump(chosen[0]['profile'], file, indent = 2)
+        print('Wrote {} ({:.1f} ms, {:.1%} agreement)'.format(
+              args.profile_out, chosen[0]['latency_ms'], chosen[0]['agreement']))
+
+
+if __name__ == '__main__':
+    main()
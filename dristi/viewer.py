@@ -0,0 +1,95 @@
+import time
+from threading import Thread, Condition
+
+import cv2
+import numpy as np
+
+
+class LatestSlot(object):
+    '''A single item slot holding only the most recent value. Writers never block on
+    readers, and readers wait for a value newer than the one they saw last.
+    Methods:
+    put
+    get
+    '''
+    def __init__(self):
+        self.value = None
+        self.version = 0
+        self.condition = Condition()
+
+    def put(self, value):
+        '''Description: Replace the value held by the slot.
+        '''
+        with self.condition:
+            self.value = value
+            self.version += 1
+            self.condition.notify_all()
+
+    def get(self, version = 0, timeout = None):
+        '''Description: Wait for a value newer than version.
+        Return:
+        version, value: The current version and value, value is None on timeout.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.version > version, timeout):
+                return version, None
+            return self.version, self.value
+
+
+class DebugViewer(object):
+    '''A class to display the rectified frames and the disparity map on its own thread.
+    Frames are handed over through a latest-only slot, so the processing loop never waits
+    on the display, and at most fps frames per second are copied for display.
+    Methods:
+    start
+    show
+    stop
+    '''
+    def __init__(self, fps = 10, line_spacing = 20):
+        '''
+        Parameters:
+        fps: Maximum display rate.
+        line_spacing: Spacing of the horizontal lines drawn to check rectification.
+        '''
+        self.period = 1.0 / fps
+        self.line_spacing = line_spacing
+        self.slot = LatestSlot()
+        self.last_shown = 0.0
+        self.stopped = False
+
+    def start(self):
+        '''Description: Start the display thread.
+        '''
+        self.t = Thread(target = self._display)
+        self.t.daemon = True
+        self.t.start()
+        return self
+
+    def show(self, left_img, right_img, disparity):
+        '''Description: Offer a frame for display. Returns immediately, and drops the frame
+        if the previous one was offered less than a display period ago.
+        '''
+        now = time.monotonic()
+        if now - self.last_shown < self.period:
+            return
+        self.last_shown = now
+        # The slot holds private copies, so callers are free to reuse their buffers
+        frames = np.hstack((left_img, right_img))
+        self.slot.put((frames, disparity.copy()))
+
+    def _display(self):
+        version = 0
+        while not self.stopped:
+            version, frame = self.slot.get(version, timeout = 0.1)
+            if frame is not None:
+                frames, disparity = frame
+                frames[::self.line_spacing, :] = 255
+                cv2.imshow('frames', frames)
+                cv2.imshow('disparity', cv2.applyColorMap(disparity, cv2.COLORMAP_JET))
+            cv2.waitKey(1)
+        cv2.destroyAllWindows()
+
+    def stop(self):
+        '''Description: Stop the display thread.
+        '''
+        self.stopped = True